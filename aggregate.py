@@ -18,12 +18,186 @@ Adapted by: Natalie Popescu 2020
 """
 import os
 import sys
-from subprocess import check_output
+import json
 import re
 import argparse
 
 default_type = 1
 
+# criterion prints times in the unit that suits them best
+UNITS = {"ps": 1e-3, "ns": 1.0, "us": 1e3, "\u00b5s": 1e3, "\u03bcs": 1e3, "ms": 1e6, "s": 1e9}
+CRITERION_TIME = re.compile(
+    r"^(.*?)\s*time:\s+\[([0-9.]+)\s(\S+)\s+([0-9.]+)\s(\S+)\s+([0-9.]+)\s(\S+)\]")
+CRITERION_ANALYZING = re.compile(r"^Benchmarking (.+): Analyzing")
+# metacharacters of the Rust regexes of criterion's filters; older versions
+# of the regex crate reject the escape of anything else (e.g. of a space)
+RUST_REGEX_META = re.compile(r"([\\.+*?()|\[\]{}^$])")
+
+def exact_filter(names):
+    """ criterion filter (a Rust regex) that matches exactly the benchmark
+    ids in names
+    """
+    return "^({})$".format("|".join(RUST_REGEX_META.sub(r"\\\1", name) for name in sorted(names)))
+
+class StreamParser:
+    """ Parse criterion's output as it is printed: feed() it one line at a
+    time, and it returns (name, (lo, mid, hi)) with the time estimates in
+    nanoseconds for the line that completes a benchmark, None otherwise
+    """
+    def __init__(self):
+        self.name = None
+
+    def feed(self, line):
+        m = CRITERION_ANALYZING.match(line)
+        if m:
+            self.name = m.group(1).strip()
+            return None
+        m = CRITERION_TIME.match(line)
+        if not m:
+            return None
+        # long ids are printed on a line of their own before the times
+        name = m.group(1).strip() or self.name
+        self.name = None
+        if not name:
+            return None
+        times = []
+        for i in (2, 4, 6):
+            times.append(float(m.group(i)) * UNITS.get(m.group(i + 1), 1.0))
+        return name, tuple(times)
+
+def parse_criterion(text):
+    """ Map each benchmark in criterion's output to its (lo, mid, hi)
+    time estimates, in nanoseconds
+    """
+    parser = StreamParser()
+    results = dict()
+    for line in text.splitlines():
+        result = parser.feed(line)
+        if result != None:
+            results[result[0]] = result[1]
+    return results
+
+BENCHER_TIME = re.compile(r"^test\s+(.+?)\s+\.\.\.\s+bench:\s+([0-9,]+)\D+([0-9,]+)", re.MULTILINE)
+
+def parse_bencher(text):
+    """ Map each benchmark in libtest's bench output to its
+    (ns/iter, +/-) as printed
+    """
+    return {m.group(1): (m.group(2), m.group(3)) for m in BENCHER_TIME.finditer(text)}
+
+def write_result(filehandle, name, times):
+    """ Append a result of StreamParser to a results file, one
+    benchmark per line, right away
+    """
+    filehandle.write("\t".join([name] + [repr(time) for time in times]) + "\n")
+    filehandle.flush()
+
+def read_results(filepath):
+    """ Map each benchmark in a results file to its (lo, mid, hi) time
+    estimates, in nanoseconds
+    """
+    results = dict()
+    with open(filepath, "r") as handle:
+        for line in handle:
+            columns = line.rstrip("\n").split("\t")
+            # the last line of an interrupted run may be cut short
+            if len(columns) != 4:
+                continue
+            try:
+                results[columns[0]] = tuple(float(column) for column in columns[1:])
+            except ValueError:
+                continue
+    return results
+
+def load_estimates(criterion_dir):
+    """ Map each benchmark (by full id) whose results criterion left in
+    criterion_dir (<target>/criterion, or a copy of it) to its (lo, mid, hi)
+    time estimates and to its per-iteration samples, in nanoseconds
+    """
+    estimates = dict()
+    samples = dict()
+    for dirpath, dirnames, filenames in os.walk(criterion_dir):
+        # <id>/new holds the latest run, <id>/base the one before
+        if os.path.basename(dirpath) != "new" or "benchmark.json" not in filenames:
+            continue
+        try:
+            with open(os.path.join(dirpath, "benchmark.json"), "r") as fd:
+                full_id = json.load(fd)["full_id"]
+            with open(os.path.join(dirpath, "estimates.json"), "r") as fd:
+                est = json.load(fd)
+        except (OSError, ValueError, KeyError):
+            continue
+        # as in criterion's report: the slope if it sampled linearly, else the mean
+        typical = est.get("slope") or est["mean"]
+        interval = typical["confidence_interval"]
+        estimates[full_id] = (interval["lower_bound"], typical["point_estimate"],
+            interval["upper_bound"])
+        try:
+            with open(os.path.join(dirpath, "sample.json"), "r") as fd:
+                sample = json.load(fd)
+            samples[full_id] = [time / iters for time, iters in zip(sample["times"], sample["iters"])]
+        except (OSError, ValueError, KeyError):
+            pass
+    return dict(sorted(estimates.items())), samples
+
+def dump_estimates(
+    filepath,
+    unmod,
+    regex,
+    samplepath=None,
+    headers=['#','bench-name','unmod-time', 'unmod-error','regex-time','regex-error']):
+    """
+    Same output as dump_benchmark, from the criterion dirs unmod and regex
+    instead of the text output. The samples of both go to samplepath
+    (json) if given.
+    """
+    unmod_est, unmod_samples = load_estimates(unmod)
+    regex_est, regex_samples = load_estimates(regex)
+    rows = dump_matched(filepath, unmod_est, regex_est, headers)
+
+    if samplepath != None:
+        with open(samplepath, "w") as handle:
+            json.dump({re.sub(r"\s", "_", name): {"unmod": unmod_samples.get(name, []),
+                "regex": regex_samples.get(name, [])} for name in sorted(unmod_est) if name in regex_est},
+                handle)
+    return rows
+
+def dump_results(
+    filepath,
+    unmod,
+    regex,
+    headers=['#','bench-name','unmod-time', 'unmod-error','regex-time','regex-error']):
+    """
+    Same output as dump_benchmark, from the results files (see
+    write_result) unmod and regex
+    """
+    return dump_matched(filepath, read_results(unmod), read_results(regex), headers)
+
+def matched_rows(unmod_est, regex_est):
+    """ Rows of the benchmarks (by name, in the order of unmod_est) with
+    (lo, mid, hi) estimates on both sides: name, and the middle estimate
+    and error of each side
+    """
+    output = []
+    for name, unmod_line in unmod_est.items():
+        if name not in regex_est:
+            continue
+        line = [re.sub(r"\s", "_", name)]
+        for lo, mid, hi in (unmod_line, regex_est[name]):
+            # other two numbers we take the avg of diff -> error
+            line.append(str(mid))
+            line.append(str(((mid - lo) + (hi - mid)) / 2))
+        output.append(line)
+    return output
+
+def dump_matched(filepath, unmod_est, regex_est, headers):
+    output = matched_rows(unmod_est, regex_est)
+    path_wrangle(filepath, headers)
+    with open(filepath, "a") as handle:
+        for elem in output:
+            writerow(handle, elem)
+    return output
+
 def dump_benchmark(
     filepath,
     unmod,
@@ -34,62 +208,33 @@ def dump_benchmark(
     """
     Customise with your own output path and header row.
     idep_var is an optional independent variable.
+    Returns the rows written for the benchmarks.
     """
+    # capture benchmark output
+    with open(unmod, "r", errors="replace") as handle:
+        unmod_text = handle.read()
+    with open(regex, "r", errors="replace") as handle:
+        regex_text = handle.read()
+
+    # benchmarks are matched by name, so that one that only shows up on
+    # one side does not shift all the others
     if bench_type == 0:
-        pattern = "bench:\s+([0-9,]*)\D+([0-9,]*)"
-        name_pattern = "(?<=test\s).*(?=\s+[.]{3}\s+bench)"
+        unmod_result = parse_bencher(unmod_text)
+        regex_result = parse_bencher(regex_text)
+        output = []
+        for name, unmod_line in unmod_result.items():
+            if name not in regex_result:
+                continue
+            # grab and append benchmark name to line
+            line = [re.sub(r"\s", "_", name)]
+            # grab each of the two numbers per line, of each side
+            for num in unmod_line + regex_result[name]:
+                # get rid of nasty commas
+                line.append(num.translate({ord(','): None}))
+            output.append(line)
     else: 
-        #pattern = "time:\s+\[([0-9,.]+)\s[a-z]s\s+([0-9,.]+)\s[a-z]s\s+([0-9,.]+)\s[a-z]s\]"
-        pattern = "time:\s+\[([0-9,.]+)\s[a-z]+s\s+([0-9,.]+)\s[a-z]+s\s+([0-9,.]+)\s[a-z]+s\]"
-        name_pattern = "(?<=Analyzing\n).+(?=\s+time)"
-
-    # capture benchmark output
-    bnames = re.findall(name_pattern, check_output(["cat", unmod]).decode('utf-8'))
-    unmod_result = re.findall(pattern, check_output(["cat", unmod]).decode('utf-8'))
-    regex_result = re.findall(pattern, check_output(["cat", regex]).decode('utf-8'))
-    #print(bnames)
-    #print()
-    #print(unmod_result)
-    #print(regex_result)
-    # get rid of nasty commas
-    output = []
-    unmod_len = len(unmod_result)
-    regex_len = len(regex_result)
-    length = unmod_len if unmod_len < regex_len else regex_len
-    #print(length)
-    for i in range(length):
-        line = []
-        # grab and append benchmark name to line
-        bname = re.sub("\s", "_", bnames[i].strip())
-        line.append(bname)
-        # grab each matched line
-        unmod_line = unmod_result[i]
-        regex_line = regex_result[i]
-        if bench_type == 0:
-            # grab each of the two numbers per line
-            for num in unmod_line:
-                tnum = num.translate({ord(','): None})
-                line.append(tnum)
-            for num in regex_line:
-                tnum = num.translate({ord(','): None})
-                line.append(tnum)
-        else: 
-            # three number per line; middle is the best estimate
-            unmod_mid = unmod_line[1]
-            regex_mid = regex_line[1]
-            # other two numbers we take the avg of diff -> error
-            u_lo = float(unmod_mid) - float(unmod_line[0])
-            u_hi = float(unmod_line[2]) - float(unmod_mid)
-            unmod_err = str((u_lo + u_hi) / 2)
-            b_lo = float(regex_mid) - float(regex_line[0])
-            b_hi = float(regex_line[2]) - float(regex_mid)
-            regex_err = str((b_lo + b_hi) / 2)
-            # add to line
-            line.append(unmod_mid)
-            line.append(unmod_err)
-            line.append(regex_mid)
-            line.append(regex_err)
-        output.append(line)
+        output = matched_rows(parse_criterion(unmod_text), parse_criterion(regex_text))
+    rows = list(output)
     # any other kwargs will be written as a CSV header row and value
     # nothing prevents you from writing rows that don't have a header
     for k, v in kwargs.items():
@@ -101,6 +246,7 @@ def dump_benchmark(
     with open(filepath, "a") as handle:
         for elem in output:
             writerow(handle, elem)
+    return rows
 
 def path_wrangle(filepath, headers):
     """ Check for or create path and output file
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# Bisect the converted bounds checks of a crate down to the ones that cost time
+#
+# Starting from the sites in the mir-filelist of a converted crate (or, for
+# a crate converted by regexify alone, from every call it converts), convert
+# subsets of them (every other site stays unchecked), rebuild the crate and
+# rerun only the benchmarks that the full conversion slowed down. A subset
+# that does not slow them down is dropped, one that does is split in half,
+# until only single hot sites are left.
+import os
+import sys
+import argparse
+import subprocess
+from statistics import median
+from regexify import findTargetFiles, findTargetFilesOld, findCallSpans, convertFile
+from aggregate import parse_criterion, exact_filter
+
+ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
+UNSAFE_DIR = os.path.join(ROOT_PATH, "unsafe-crates")
+SAFE_DIR = os.path.join(ROOT_PATH, "safe-crates")
+MIR_FILELIST = "mir-filelist"
+BISECT_LOG = "bisect.log"
+HOT_SITES = "hot-sites.txt"
+
+# [(fname, (line_start, col_start, line_end, col_end)), ...]
+def load_sites(unsafe_crate, safe_crate):
+    if not os.path.exists(os.path.join(safe_crate, MIR_FILELIST)):
+        return scan_sites(unsafe_crate)
+    with open(os.path.join(safe_crate, MIR_FILELIST), "r") as fd:
+        filelist = findTargetFiles(fd)
+
+    sites = []
+    for fname, spans in filelist.items():
+        # only files inside the crate (including vendor/) have a pristine
+        # copy in the unsafe crate to convert from
+        if os.path.isabs(fname) or fname.startswith(".."):
+            continue
+        for span in spans:
+            sites.append((fname, span))
+    return sites
+
+# Without a mir-filelist, regexify converted every call it found, so the
+# candidates are those calls in the pristine sources, found the same way
+def scan_sites(unsafe_crate):
+    os.chdir(unsafe_crate)
+    sites = []
+    for fname in findTargetFilesOld():
+        fname = os.path.normpath(fname)
+        # build output, not a source of the crate
+        if fname.split(os.sep)[0] == "target":
+            continue
+        with open(fname, "r") as fd:
+            for span in findCallSpans(fd.read()):
+                sites.append((fname, span))
+    return sites
+
+# Reconvert every file that has candidate sites from its pristine copy,
+# converting only the sites in subset. convertFile leaves files whose content
+# does not change alone, so cargo only rebuilds what was touched.
+def apply_sites(unsafe_crate, safe_crate, sites, subset):
+    spans = dict()
+    for fname, span in sites:
+        spans.setdefault(fname, [])
+    for fname, span in subset:
+        spans[fname].append(span)
+
+    os.chdir(safe_crate)
+    for fname in spans:
+        if convertFile(os.path.join(unsafe_crate, fname), fname, spans[fname]) == None:
+            sys.exit("Conversion failed in {}".format(fname))
+
+def build(crate_dir):
+    with open(os.path.join(crate_dir, BISECT_LOG), "a") as log:
+        ret = subprocess.run(["cargo", "bench", "--verbose", "--no-run"],
+            cwd=crate_dir, stdout=log, stderr=log)
+    if ret.returncode != 0:
+        sys.exit("Build failed in {}, see {}".format(crate_dir, BISECT_LOG))
+
+# median of the <mid> estimates of each benchmark over <runs> runs, in ns
+def measure(crate_dir, bench_filter, runs):
+    cmd = ["cargo", "bench"]
+    if bench_filter:
+        cmd += ["--", bench_filter]
+    times = dict()
+    for run in range(runs):
+        out = subprocess.run(cmd, cwd=crate_dir, timeout=1800,
+            capture_output=True, text=True)
+        for name, (lo, mid, hi) in parse_criterion(out.stdout).items():
+            times.setdefault(name, []).append(mid)
+    return {name: median(mids) for name, mids in times.items()}
+
+# {benchmark: converted / baseline - 1}
+def slowdowns(baseline, times):
+    return {name: times[name] / baseline[name] - 1
+            for name in times if baseline.get(name)}
+
+def bisect(sites, is_hot):
+    hot = []
+    pending = [sites]
+    while pending:
+        subset = pending.pop()
+        if not is_hot(subset):
+            continue
+        if len(subset) == 1:
+            hot.append(subset[0])
+            continue
+        half = len(subset) // 2
+        pending.append(subset[half:])
+        pending.append(subset[:half])
+    return sorted(hot)
+
+def dump_sites(sites, logfile):
+    with open(logfile, "w") as fd:
+        for fname, (line_start, col_start, line_end, col_end) in sites:
+            # same format as the mir-filelist
+            fd.write("{}:{}:{}: {}:{}\n".format(fname, line_start, col_start, line_end, col_end))
+
+def arg_parse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--crate", "-c",
+        metavar="name-v.v.v",
+        type=str,
+        required=True,
+        help="crate (as named in unsafe-crates/safe-crates) whose converted "\
+            "sites to bisect")
+    parser.add_argument("--bench-filter", "-b",
+        metavar="regex",
+        type=str,
+        help="only consider the criterion benchmarks matching this filter")
+    parser.add_argument("--threshold", "-t",
+        metavar="F",
+        type=float,
+        default=0.05,
+        help="relative slowdown above which a set of sites counts as hot "\
+            "(default is 0.05)")
+    parser.add_argument("--num-runs", "-n",
+        metavar="N",
+        type=int,
+        default=1,
+        help="number of benchmark runs per measurement (default is 1)")
+    args = parser.parse_args()
+    return args.crate, args.bench_filter, args.threshold, args.num_runs
+
+if __name__ == "__main__":
+    crate, bench_filter, threshold, num_runs = arg_parse()
+    unsafe_crate = os.path.join(UNSAFE_DIR, crate)
+    safe_crate = os.path.join(SAFE_DIR, crate)
+
+    sites = load_sites(unsafe_crate, safe_crate)
+    print("{} candidate sites".format(len(sites)))
+
+    print("Measuring baseline")
+    build(unsafe_crate)
+    baseline = measure(unsafe_crate, bench_filter, num_runs)
+
+    # Only the benchmarks slowed down by the full conversion are rerun
+    print("Measuring full conversion")
+    apply_sites(unsafe_crate, safe_crate, sites, sites)
+    build(safe_crate)
+    full = slowdowns(baseline, measure(safe_crate, bench_filter, num_runs))
+    affected = [name for name, slowdown in full.items() if slowdown > threshold]
+    if not affected:
+        sys.exit("No benchmark is more than {:.1%} slower".format(threshold))
+    for name in sorted(affected):
+        print("\t{}: {:+.1%}".format(name, full[name]))
+    affected_filter = exact_filter(affected)
+
+    steps = 0
+    def is_hot(subset):
+        global steps
+        # the full set was just measured
+        if len(subset) == len(sites):
+            return True
+        steps += 1
+        apply_sites(unsafe_crate, safe_crate, sites, subset)
+        build(safe_crate)
+        times = slowdowns(baseline, measure(safe_crate, affected_filter, num_runs))
+        worst = max(times.values(), default=0)
+        print("Step {}: {} sites, {:+.1%}".format(steps, len(subset), worst))
+        return worst > threshold
+
+    hot = bisect(sites, is_hot)
+
+    # Leave the crate fully converted, as it was
+    apply_sites(unsafe_crate, safe_crate, sites, sites)
+
+    if not hot:
+        print("The slowdown only shows up with several sites converted together")
+    else:
+        print("{} hot sites:".format(len(hot)))
+        for fname, (line_start, col_start, line_end, col_end) in hot:
+            print("\t{}:{}:{}".format(fname, line_start, col_start))
+    dump_sites(hot, os.path.join(safe_crate, HOT_SITES))
@@ -11,18 +11,36 @@ from statistics import median
 
 def stats2(array):
     list_arr = array.tolist()
-    # drop two highest
-    list_arr.remove(max(list_arr))
-    list_arr.remove(max(list_arr))
-    # drop two lowest
-    list_arr.remove(min(list_arr))
-    list_arr.remove(min(list_arr))
+    # with enough values (benchmarks missing from some runs may have fewer)
+    if len(list_arr) >= 5:
+        # drop two highest
+        list_arr.remove(max(list_arr))
+        list_arr.remove(max(list_arr))
+        # drop two lowest
+        list_arr.remove(min(list_arr))
+        list_arr.remove(min(list_arr))
     # median calc
     med = median(list_arr)
     # standard deviation calc
     stdev = stddev(list_arr, average(list_arr))
     return med, stdev
 
+# two-sided 95% quantiles of Student's t, for 1 to 30 degrees of freedom
+T95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+        2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+        2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+def ci95(array):
+    # mean and half-width of the 95% confidence interval of the mean
+    length = len(array)
+    avg = average(array)
+    if length < 2:
+        return avg, math.inf
+    # sample standard deviation
+    stdev = stddev(array, avg) * math.sqrt(length / (length - 1))
+    t = T95[length - 2] if length - 1 <= len(T95) else 1.96
+    return avg, t * stdev / math.sqrt(length)
+
 def stats(array):
     # average calc
     avg = average(array)
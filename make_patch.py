@@ -5,6 +5,7 @@ import os
 import re
 import subprocess
 import shutil
+from sitedb import converted_packages
 
 def convert(root):
     if os.path.exists(root): 
@@ -23,9 +24,10 @@ def convert(root):
                     except OSError as err: 
                         print("Error: {} : {}".format(full_path, err.strerror))
 
-def patchAll(toml_dir, rel_root, root):
+def patchAll(toml_dir, rel_root, root, deps=None):
     toml = open(os.path.join(toml_dir, "Cargo.toml"), "a")
-    to_patch = os.listdir(root)
+    # a vendor dir shared by several crates has more than their dependencies
+    to_patch = [dep for dep in os.listdir(root) if deps == None or dep in deps]
     patches = dict()
     versioned = []
     unversioned = []
@@ -82,17 +84,20 @@ def patchAll(toml_dir, rel_root, root):
         #print(all_lines)
         toml.write("".join(patch_str))
 
-def patch(toml_dir, rel_root, root):
+def patch(toml_dir, rel_root, root, site_db=None, crate=None):
     toml = open(os.path.join(toml_dir, "Cargo.toml"), "a")
 
     # only patch the crates that have actually been converted
     to_patch = []
-    changes = open(os.path.join(root, "changes.txt"), "r")
-    for line in changes.readlines():
-        print(line)
-        changed_file = line.split()[2]
-        crate = changed_file.split("/")[0]
-        to_patch.append(crate)
+    if site_db:
+        to_patch = converted_packages(site_db, crate)
+    else:
+        changes = open(os.path.join(root, "changes.txt"), "r")
+        for line in changes.readlines():
+            print(line)
+            changed_file = line.split()[2]
+            crate = changed_file.split("/")[0]
+            to_patch.append(crate)
     to_patch = list(dict.fromkeys(to_patch))
     for p in to_patch: 
         print(p)
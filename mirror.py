@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# Local content-addressed mirror of the crates.io tarballs
+#
+# <mirror>/index.json maps name-version to the sha256 of the crate's
+# tarball, which is stored as <mirror>/blobs/<sha256>.crate. A crate is
+# only fetched from crates.io the first time it is asked for, so a filled
+# mirror can be reused by later campaigns, copied to other machines, and
+# lets the corpus be set up without network access.
+import os
+import sys
+import json
+import shutil
+import argparse
+import hashlib
+import tarfile
+import tempfile
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+CRATES_IO = "https://crates.io/api/v1/crates/{}/{}/download"
+USER_AGENT = "cio (checked indexing overhead benchmarks)"
+INDEX = "index.json"
+BLOBS = "blobs"
+THREADS = 8
+
+# the threads of fetch_all share the index
+index_lock = threading.Lock()
+
+def load_index(mirror):
+    try:
+        with open(os.path.join(mirror, INDEX), "r") as fd:
+            return json.load(fd)
+    except FileNotFoundError:
+        return dict()
+
+def save_index(mirror, index):
+    tmp = os.path.join(mirror, INDEX + ".tmp.{}".format(os.getpid()))
+    with open(tmp, "w") as fd:
+        json.dump(index, fd, indent=4, sort_keys=True)
+    os.replace(tmp, os.path.join(mirror, INDEX))
+
+def blob_path(mirror, sha):
+    return os.path.join(mirror, BLOBS, "{}.crate".format(sha))
+
+def sha256_file(fname):
+    digest = hashlib.sha256()
+    with open(fname, "rb") as fd:
+        for chunk in iter(lambda: fd.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def fetch(mirror, crate):
+    """ Path of the tarball of crate (name/version) in the mirror,
+    downloading it first if the mirror does not have it (intact)
+    """
+    name, version = crate.split("/")
+    key = "{}-{}".format(name, version)
+    with index_lock:
+        sha = load_index(mirror).get(key)
+    if sha and os.path.exists(blob_path(mirror, sha)) and \
+            sha256_file(blob_path(mirror, sha)) == sha:
+        return blob_path(mirror, sha)
+
+    request = urllib.request.Request(CRATES_IO.format(name, version),
+        headers={"User-Agent": USER_AGENT})
+    with urllib.request.urlopen(request, timeout=300) as response:
+        data = response.read()
+    sha = hashlib.sha256(data).hexdigest()
+
+    os.makedirs(os.path.join(mirror, BLOBS), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.join(mirror, BLOBS))
+    with os.fdopen(fd, "wb") as tmpfd:
+        tmpfd.write(data)
+    os.replace(tmp, blob_path(mirror, sha))
+    with index_lock:
+        index = load_index(mirror)
+        index[key] = sha
+        save_index(mirror, index)
+    return blob_path(mirror, sha)
+
+def check_members(tar, dest):
+    """ Refuse archives with members (or links) that would end up outside
+    of dest, or that are not plain files, directories or links
+    """
+    dest = os.path.realpath(dest)
+    for member in tar.getmembers():
+        path = os.path.realpath(os.path.join(dest, member.name))
+        targets = [path]
+        if member.issym():
+            targets.append(os.path.realpath(os.path.join(os.path.dirname(path), member.linkname)))
+        elif member.islnk():
+            targets.append(os.path.realpath(os.path.join(dest, member.linkname)))
+        elif not (member.isfile() or member.isdir()):
+            raise ValueError("unsupported member {}".format(member.name))
+        for target in targets:
+            if not target.startswith(dest + os.sep):
+                raise ValueError("member {} points outside of the archive".format(member.name))
+    return tar.getmembers()
+
+def extract(blob, dest):
+    """ Extract the tarball in blob into dest. Its top level dirs (the
+    name-version dir of a crate) replace those already in dest as a whole,
+    so an interrupted extraction never leaves a partial crate behind
+    """
+    tmp = tempfile.mkdtemp(dir=dest, prefix=".extract-")
+    try:
+        with tarfile.open(blob, "r:gz") as tar:
+            members = check_members(tar, tmp)
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(tmp, members, filter="data")
+            else:
+                tar.extractall(tmp, members)
+        for top in os.listdir(tmp):
+            shutil.rmtree(os.path.join(dest, top), ignore_errors=True)
+            os.rename(os.path.join(tmp, top), os.path.join(dest, top))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def fetch_all(mirror, crates, dest=None, threads=THREADS):
+    """ Fetch the crates (name/version) into the mirror, and extract them
+    into dest if given. Returns {crate: error message, or None}
+    """
+    def fetch_one(crate):
+        try:
+            blob = fetch(mirror, crate)
+            if dest != None:
+                extract(blob, dest)
+            return None
+        except Exception as err:
+            return str(err)
+
+    os.makedirs(mirror, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return dict(zip(crates, executor.map(fetch_one, crates)))
+
+def arg_parse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mirror", "-m",
+        metavar="path",
+        type=str,
+        required=True,
+        help="mirror dir to fill")
+    parser.add_argument("--crates", "-c",
+        metavar="name/v.v.v",
+        type=str,
+        nargs="+",
+        required=True,
+        help="versioned crates to add to the mirror")
+    args = parser.parse_args()
+    return args.mirror, args.crates
+
+if __name__ == "__main__":
+    mirror, crates = arg_parse()
+    failed = 0
+    for crate, err in fetch_all(mirror, crates).items():
+        if err != None:
+            print("{}: {}".format(crate, err))
+            failed += 1
+    if failed:
+        sys.exit("{} of {} crates could not be fetched".format(failed, len(crates)))
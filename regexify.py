@@ -2,17 +2,37 @@
 # Convert get_unchecked(_mut), and from_raw_parts(_mut) to safe version
 import re
 import os
+import sys
 import subprocess
 import argparse
+import bisect
+import hashlib
+import json
+import mmap
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from make_patch import patchAll
+from sitedb import record_sites
 
-# [(line, col, fname), ...]
+# bump whenever convertBlock changes its output or its records, so that
+# entries of older conversions are no longer hit
+CACHE_VERSION = 4
+
+# what matters to tell which function a site is in: comments, string and
+# character literals (to skip), fn names, brackets and semicolons
+FN_TOKENS = re.compile(r'//[^\n]*|/\*|\bb?r(#*)"|b?"(?:\\.|[^"\\])*"|'
+        r"b?'(?:\\u\{[0-9a-fA-F]+\}|\\.|[^'\\])'|"
+        r'\bfn\s+([A-Za-z_][A-Za-z0-9_]*)|[{}()\[\];]')
+BLOCK_COMMENT = re.compile(r'/\*|\*/')
+
+# [(line, col, fname, kind, function), ...]
 def dumpBCs(bcs, logfile=None):
     if not logfile:
         return
 
     with open(logfile, 'w') as fd:
-        for (line, col, fname) in bcs:
+        for (line, col, fname, kind, function) in bcs:
             # get rid of the initial "./"
             if fname.startswith("./"):
                 fname = fname[2:]
@@ -21,251 +41,601 @@ def dumpBCs(bcs, logfile=None):
             fd.write("%d %d %s\n" % (line, col, fname))
 
 
+# a line in mir_filelist looks something like: src/lib.rs:28:42: 28:62 (#0)
+MIR_SPAN = re.compile(r'^(.+):(\d+):(\d+):\s*(\d+):(\d+)')
+
+
+# The file is streamed one line at a time, so only the distinct spans are
+# kept in memory, however large the filelist is.
+# dictionary structure:
+#  {
+#    filename1: [
+#        (line_start, col_start, line_end, col_end),
+#    ],
+#    filename2: [
+#        (line_start, col_start, line_end, col_end),
+#        (line_start, col_start, line_end, col_end),
+#    ],
+#  }
+# with the spans of each file sorted
 def findTargetFiles(mir_file): #single_file):
-    # a line in mir_filelist looks something like: src/lib.rs:28:42: 28:62 (#0)
     filelist = dict()
 
-    lines = mir_file.readlines()
-    #lines = mir_filelist.strip().split("\n")
-    for line in lines:
-        parts = line.split(":")
-        filename = parts[0].strip()
-        line_start = parts[1].strip()
-        line_end = parts[3].strip()
-        col_start = parts[2].strip()
-        col_end = parts[4].split("(")[0].strip()
-
-        # dictionary structure: 
-        #  { 
-        #    filename1: [
-        #        [line_start, line_end, col_start, col_end], 
-        #    ],
-        #    filename2: [
-        #        [line_start, line_end, col_start, col_end], 
-        #        [line_start, line_end, col_start, col_end], 
-        #    ],
-        #  }
-        if filelist.get(filename): 
-            #print("filename already exists")
-            entries = filelist.get(filename)
-            new_entry = int(line_start) #, 
-            #    int(line_end), 
-            #    int(col_start), 
-            #    int(col_end)
-            #]
-            if new_entry in entries: 
-                continue
-            entries.append(new_entry)
-            filelist.update({filename: entries})
-        else: 
-            #print("filename does not yet exist")
-            entry = int(line_start) #, 
-            #    int(line_end), 
-            #    int(col_start), 
-            #    int(col_end)
-            #]
-            filelist.update({filename: [entry]})
+    for line in mir_file:
+        m = MIR_SPAN.match(line)
+        if not m:
+            continue
+        filename = m.group(1).strip()
+        span = (int(m.group(2)), int(m.group(3)), int(m.group(4)), int(m.group(5)))
+
+        spans = filelist.get(filename)
+        if spans == None:
+            spans = filelist[filename] = set()
+        spans.add(span)
+
+    for filename in filelist:
+        filelist[filename] = sorted(filelist[filename])
 
     return filelist
 
 
-def findTargetFilesOld():
-    target = "."
-    rs_files = subprocess.run(["find", target, "-name", "*.rs", "-type", "f"], 
-            capture_output=True, text=True)
-    filelist = rs_files.stdout.split()
+def findTargetFilesOld(target="."):
+    ignore = None
     if os.path.exists("ignore.txt"):
         with open("ignore.txt", 'r') as fd:
-            lines = fd.readlines()
-            ignore_list = [i.strip() for i in lines]
-
-        final_list = filelist.copy()
-        for f in filelist:
-            for ignore in ignore_list:
-                if ignore in f:
-                    if f in final_list:
-                        final_list.remove(f)
-
-        print("Removed", len(filelist) - len (final_list), "files")
-        filelist = final_list
-    return filelist
+            ignore = compileIgnore(fd.readlines())
+
+    filelist, ignored = walkSources(target, ignore)
+    if ignore:
+        print("Removed", ignored, "ignored paths")
+
+    # cheap byte-level check before any file gets parsed
+    final_list = [f for f in filelist if mayContainCalls(f)]
+    print("Skipped", len(filelist) - len(final_list), "files without get_unchecked")
+    return final_list
+
+
+# every line of ignore.txt is either a plain string, which ignores all the
+# paths that contain it, or a gitignore-style glob: "*" and "?" stay within
+# one path component, "**" spans several, the glob has to match whole path
+# components, and a leading "/" anchors it at the root
+# returns a single compiled regex, or None if there is nothing to ignore
+def compileIgnore(lines):
+    alternatives = []
+    for line in lines:
+        pattern = line.strip()
+        if not pattern or pattern.startswith("#"):
+            continue
+        if not any(ch in pattern for ch in "*?["):
+            alternatives.append(re.escape(pattern))
+        elif pattern.startswith("/"):
+            alternatives.append(r'^\./' + globToRegex(pattern.strip("/")) + r'(?:/|$)')
+        else:
+            alternatives.append(r'(?:^|/)' + globToRegex(pattern.strip("/")) + r'(?:/|$)')
+
+    if not alternatives:
+        return None
+    return re.compile("|".join(alternatives))
+
+
+def globToRegex(glob):
+    regex = []
+    i = 0
+    while i < len(glob):
+        ch = glob[i]
+        if glob.startswith("**", i):
+            regex.append(r'.*')
+            i += 2
+            continue
+        if ch == "*":
+            regex.append(r'[^/]*')
+        elif ch == "?":
+            regex.append(r'[^/]')
+        elif ch == "[" and glob.find("]", i + 1) != -1:
+            end = glob.find("]", i + 1)
+            chars = glob[i+1:end]
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            regex.append("[" + chars.replace("\\", "\\\\") + "]")
+            i = end
+        else:
+            regex.append(re.escape(ch))
+        i += 1
+    return "".join(regex)
+
+
+# same list of files as `find root -name "*.rs" -type f`, minus the ignored
+# ones; ignored directories are not descended into at all
+# returns (files, number of ignored paths)
+def walkSources(root, ignore=None):
+    filelist = []
+    ignored = 0
+    dirs = [root]
+
+    while dirs:
+        top = dirs.pop()
+        try:
+            with os.scandir(top) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            continue
+
+        subdirs = []
+        for entry in entries:
+            path = os.path.join(top, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                if ignore and ignore.search(path + "/"):
+                    ignored += 1
+                else:
+                    subdirs.append(path)
+            elif entry.is_file(follow_symlinks=False) and entry.name.endswith(".rs"):
+                if ignore and ignore.search(path):
+                    ignored += 1
+                else:
+                    filelist.append(path)
+
+        # keep the walk in sorted, depth-first order
+        dirs.extend(reversed(subdirs))
+
+    return filelist, ignored
+
+
+# files without the bytes "get_unchecked" have nothing to convert
+def mayContainCalls(fname):
+    with open(fname, 'rb') as fd:
+        if os.fstat(fd.fileno()).st_size == 0:
+            return False
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return mm.find(b"get_unchecked") != -1
+
+
+# jobs: [(old_fname, new_fname, selective_safe, make_selective_unsafe), ...]
+# The files are independent, so with num_jobs > 1 they are sharded across a
+# process pool. The largest files are handed out first, and the bounds
+# checks are merged back in the order of jobs, so the result is the same
+# as converting one file after another.
+def convertFiles(jobs, num_jobs=1, cache_dir=None, dry_run=False):
+    bcs = []
+
+    if num_jobs <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            file_bcs = convertFile(*job, cache_dir=cache_dir, dry_run=dry_run)
+            if file_bcs == None:
+                sys.exit(1)
+            bcs.extend(file_bcs)
+        return bcs
+
+    with ProcessPoolExecutor(max_workers=num_jobs) as pool:
+        futures = [None] * len(jobs)
+        by_size = sorted(range(len(jobs)), key=lambda i: os.path.getsize(jobs[i][0]), reverse=True)
+        for i in by_size:
+            futures[i] = pool.submit(convertFile, *jobs[i], cache_dir=cache_dir, dry_run=dry_run)
+
+        for future in futures:
+            file_bcs = future.result()
+            if file_bcs == None:
+                pool.shutdown(cancel_futures=True)
+                sys.exit(1)
+            bcs.extend(file_bcs)
+
+    return bcs
+
+
+# mutregex_in = r'([($a-zA-Z_][a-zA-Z0-9:_\.\(\)\*]*)\.get_unchecked_mut\(' #]([0-9a-zA-Z_][a-zA-Z0-9_\.\>\*\+ ]*)[)]'
+# mutregex_out = r'(&mut \1[' #\2])'
+# regex_in = r'([($a-zA-Z_][a-zA-Z0-9:_\.\(\)\*]*)\.get_unchecked\(' #]([0-9a-zA-Z_][a-zA-Z0-9_\.\>\*\+ ]*)[)]'
+# regex_out = r'(&\1[' #\2])'
+
+# # handle raw parts, emitted by the macro as get_unchecked_raw(_mut)
+# raw_mutregex_in = r'([$a-zA-Z_][a-zA-Z0-9:_\.\(\)]*)\.get_unchecked_raw_mut\(' #]([0-9a-zA-Z_][a-zA-Z0-9_\.\>\*\+ ]*)[)]'
+# raw_mutregex_out = r'(&mut \1[' #\2])'
+# raw_regex_in = r'([$a-zA-Z_][a-zA-Z0-9:_\.\(\)]*)\.get_unchecked_raw\(' #]([0-9a-zA-Z_][a-zA-Z0-9_\.\>\*\+ ]*)[)]'
+# raw_regex_out = r'(&\1[' #\2])'
+mutregex_in = r'\.get_unchecked_mut\(' #]([0-9a-zA-Z_][a-zA-Z0-9_\.\>\*\+ ]*)[)]'
+mutregex_out = r'.get_mut(' #\2])'
+regex_in = r'\.get_unchecked\(' #]([0-9a-zA-Z_][a-zA-Z0-9_\.\>\*\+ ]*)[)]'
+regex_out = r'.get(' #\2])'
+#raw_mutregex_in = r'\.get_unchecked_raw_mut\(' #]([0-9a-zA-Z_][a-zA-Z0-9_\.\>\*\+ ]*)[)]'
+#raw_mutregex_out = r'.get_mut(' #\2])'
+#raw_regex_in = r'\.get_unchecked_raw\(' #]([0-9a-zA-Z_][a-zA-Z0-9_\.\>\*\+ ]*)[)]'
+#raw_regex_out = r'.get(' #\2])'
+
+# both kinds of call sites are converted in the same pass over the
+# file; each hit is tagged with the kind of the rule that matched it
+RULES = [
+    ("mut", mutregex_in, mutregex_out),
+    ("immut", regex_in, regex_out),
+    #("raw_mut", raw_mutregex_in, raw_mutregex_out),
+    #("raw_immut", raw_regex_in, raw_regex_out),
+]
 
 
 # Convert all things in place in one file
 # old_fname is the file before conversion
 # new_fname is the file after conversion 
-# selective unsafe contains the lines that we want to keep the unsafe
-def convertFile(old_fname, new_fname, selective_safe=[], make_selective_unsafe=False):
-    # mutregex_in = r'([($a-zA-Z_][a-zA-Z0-9:_\.\(\)\*]*)\.get_unchecked_mut\(' #]([0-9a-zA-Z_][a-zA-Z0-9_\.\>\*\+ ]*)[)]'
-    # mutregex_out = r'(&mut \1[' #\2])'
-    # regex_in = r'([($a-zA-Z_][a-zA-Z0-9:_\.\(\)\*]*)\.get_unchecked\(' #]([0-9a-zA-Z_][a-zA-Z0-9_\.\>\*\+ ]*)[)]'
-    # regex_out = r'(&\1[' #\2])'
-
-    # # handle raw parts, emitted by the macro as get_unchecked_raw(_mut)
-    # raw_mutregex_in = r'([$a-zA-Z_][a-zA-Z0-9:_\.\(\)]*)\.get_unchecked_raw_mut\(' #]([0-9a-zA-Z_][a-zA-Z0-9_\.\>\*\+ ]*)[)]'
-    # raw_mutregex_out = r'(&mut \1[' #\2])'
-    # raw_regex_in = r'([$a-zA-Z_][a-zA-Z0-9:_\.\(\)]*)\.get_unchecked_raw\(' #]([0-9a-zA-Z_][a-zA-Z0-9_\.\>\*\+ ]*)[)]'
-    # raw_regex_out = r'(&\1[' #\2])'
-    mutregex_in = r'\.get_unchecked_mut\(' #]([0-9a-zA-Z_][a-zA-Z0-9_\.\>\*\+ ]*)[)]'
-    mutregex_out = r'.get_mut(' #\2])'
-    regex_in = r'\.get_unchecked\(' #]([0-9a-zA-Z_][a-zA-Z0-9_\.\>\*\+ ]*)[)]'
-    regex_out = r'.get(' #\2])'
-    #raw_mutregex_in = r'\.get_unchecked_raw_mut\(' #]([0-9a-zA-Z_][a-zA-Z0-9_\.\>\*\+ ]*)[)]'
-    #raw_mutregex_out = r'.get_mut(' #\2])'
-    #raw_regex_in = r'\.get_unchecked_raw\(' #]([0-9a-zA-Z_][a-zA-Z0-9_\.\>\*\+ ]*)[)]'
-    #raw_regex_out = r'.get(' #\2])'
-    
+# selective_safe contains the spans of the calls that we want to convert, or
+# with make_selective_unsafe the spans of the calls that we want to keep unsafe
+# cache_dir, if given, holds the results of earlier conversions keyed by the
+# content of the file and the spans to convert
+# new_fname is only written if its content changes, so that cargo does not
+# rebuild untouched files; with dry_run nothing is written at all and the
+# number of edits in the file is reported instead
+def convertFile(old_fname, new_fname, selective_safe=[], make_selective_unsafe=False, cache_dir=None, dry_run=False):
     with open(old_fname, 'r') as fd:
         old_block = fd.read()
 
-    block, bcs_mut = convertBlock(old_block, mutregex_in, mutregex_out, 1, selective_safe, make_selective_unsafe)
-    if block == None or bcs_mut == None:
-        print("Conversion failed in file %s" % old_fname)
-        exit()
+    cached = None
+    if cache_dir:
+        key = cacheKey(old_block, selective_safe, make_selective_unsafe)
+        cached = loadCached(cache_dir, key)
 
-    block, bcs_immut = convertBlock(block, regex_in, regex_out, 1, selective_safe, make_selective_unsafe)
-    if block == None or bcs_immut == None:
-        print("Conversion failed in file %s" % old_fname)
-        exit()
+    if cached:
+        new_block, bcs = cached
+        if new_block == None:
+            new_block = old_block
+    else:
+        new_block, bcs = convertBlock(old_block, RULES, 1, selective_safe, make_selective_unsafe)
+        if new_block == None or bcs == None:
+            print("Conversion failed in file %s" % old_fname)
+            return None
+        bcs = enclosingFunctions(old_block, bcs)
+        if cache_dir and not dry_run:
+            storeCached(cache_dir, key, None if new_block == old_block else new_block, bcs)
+
+    if dry_run:
+        if bcs:
+            print("%s: %d edits" % (old_fname, len(bcs)))
+    elif new_fname == old_fname:
+        if new_block != old_block:
+            writeAtomic(new_fname, new_block)
+    elif readIfExists(new_fname) != new_block:
+        writeAtomic(new_fname, new_block)
 
-    #block, bcs_raw_mut = convertBlock(block, raw_mutregex_in, raw_mutregex_out)
-    #if block == None or bcs_raw_mut == None:
-    #    print("Conversion failed in file %s" % old_fname)
-    #    exit()
+    # add fname to the bcs
+    bcs = [ (line, col, new_fname, kind, function) for (line, col, kind, function) in bcs ] 
 
-    #block, bcs_raw_immut = convertBlock(block, raw_regex_in, raw_regex_out)
-    #if block == None or bcs_raw_immut == None:
-    #    print("Conversion failed in file %s" % old_fname)
-    #    exit()
+    return bcs
 
-    new_block = block
-    bcs = bcs_mut + bcs_immut # + bcs_raw_mut + bcs_raw_immut 
 
-    with open(new_fname, 'w') as fd:
-        fd.write(new_block)
+# add the name of the function each bounds check is in, i.e. of the
+# innermost function whose body spans its line, to its record; None for
+# sites outside of any function body
+def enclosingFunctions(block, bcs):
+    if not bcs:
+        return []
+    bodies = functionBodies(block, max(line for (line, col, kind) in bcs))
+    starts = [first for (first, last, name) in bodies]
+
+    def enclosing(line):
+        # the innermost body is the last one to start before line that
+        # has not ended yet
+        for idx in reversed(range(bisect.bisect_right(starts, line))):
+            first, last, name = bodies[idx]
+            if last == None or line <= last:
+                return name
+        return None
+
+    return [ (line, col, kind, enclosing(line)) for (line, col, kind) in bcs ]
+
+
+# [[first line, last line, name], ...] of the functions defined in block,
+# from their fn to the closing brace of their body (None if it is never
+# closed), in the order they start; fn in comments and literals, and
+# declarations without a body are left out
+# with until_line, the block is only read up to the end of that line (or
+# the start of the body of a fn begun by then), and the bodies still open
+# there are left with None
+def functionBodies(block, until_line=None):
+    line_starts = lineStarts(block)
+    end = len(block)
+    if until_line != None and until_line < len(line_starts):
+        end = line_starts[until_line]
+    bodies = []
+    # brackets not closed yet, each with the index in bodies of the
+    # function whose body it opens, or None
+    opened = []
+    # (name, line, depth) of the last fn whose body has not started yet
+    pending = None
+
+    pos = 0
+    while (token := FN_TOKENS.search(block, pos)):
+        # past end, only to find where the pending fn's body starts
+        if token.start() >= end and not pending:
+            break
+        text = token.group()
+        pos = token.end()
+        if text == '/*':
+            # block comments nest
+            depth = 1
+            while depth and (comment := BLOCK_COMMENT.search(block, pos)):
+                depth += 1 if comment.group() == '/*' else -1
+                pos = comment.end()
+            if depth:
+                break
+        elif token.group(1) != None:
+            # raw string, up to the quote followed by as many #
+            close = block.find('"' + token.group(1), pos)
+            if close == -1:
+                break
+            pos = close + 1 + len(token.group(1))
+        elif token.group(2) != None:
+            line = bisect.bisect_right(line_starts, token.start())
+            pending = (token.group(2), line, len(opened))
+        elif text in ('(', '[', '{'):
+            body = None
+            # the body is the first brace at the level of the fn
+            if text == '{' and pending and pending[2] == len(opened):
+                body = len(bodies)
+                bodies.append([pending[1], None, pending[0]])
+                pending = None
+            opened.append(body)
+        elif text in (')', ']', '}'):
+            if opened:
+                body = opened.pop()
+                if body != None:
+                    bodies[body][1] = bisect.bisect_right(line_starts, token.start())
+        elif text == ';':
+            # a declaration, e.g. in a trait or an extern block
+            if pending and pending[2] == len(opened):
+                pending = None
+        # anything else is a comment or a literal, skipped as a whole
+
+    return bodies
+
+
+# key of a conversion: the content of the file plus the set of target spans
+def cacheKey(block, selective_safe, make_selective_unsafe):
+    h = hashlib.sha256()
+    h.update(("%d %d %s\n" % (CACHE_VERSION, make_selective_unsafe,
+        sorted(set(selective_safe)))).encode())
+    h.update(block.encode())
+    return h.hexdigest()
+
+
+def cachePath(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key + ".json")
+
+
+# returns (new_block, bcs) of an earlier conversion, or None on a miss;
+# new_block is None if the conversion left the file as it was
+def loadCached(cache_dir, key):
+    try:
+        with open(cachePath(cache_dir, key), 'r') as fd:
+            entry = json.load(fd)
+    except (OSError, ValueError):
+        return None
+
+    bcs = [ (line, col, kind, function) for (line, col, kind, function) in entry["bcs"] ]
+    return entry["block"], bcs
+
+
+def storeCached(cache_dir, key, new_block, bcs):
+    path = cachePath(cache_dir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    writeAtomic(path, json.dumps({"block": new_block, "bcs": bcs}))
+
+
+def readIfExists(fname):
+    if not os.path.exists(fname):
+        return None
+    with open(fname, 'r') as fd:
+        return fd.read()
+
+
+# write through a temp file in the same directory and rename it into place,
+# so that readers (and concurrent writers) never see a partial file;
+# the file keeps its permissions
+def writeAtomic(fname, content):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname) or ".", prefix=".regexify-")
+    try:
+        with os.fdopen(fd, 'w') as tmpfd:
+            tmpfd.write(content)
+        if os.path.exists(fname):
+            shutil.copymode(fname, tmp)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp, 0o666 & ~umask)
+        os.replace(tmp, fname)
+    except BaseException:
+        os.unlink(tmp)
+        raise
 
-    # add fname to the bcs
-    bcs = [ (line, col, new_fname) for (line, col) in bcs ] 
 
-    return bcs
+PARENTHESES = re.compile(r'[()]')
 
 
-# already have a left parenthesis, find the matching right parenthesis
-def findMatchingParenthsis(block):
+# pair every '(' in block with its ')' in one pass over the parentheses
+# returns {open_pos: close_pos}; a '(' that is never closed is left out
+def matchParentheses(block):
     # FIXME MIR pass returns full span
+    closing = dict()
+    opened = []
+
+    for paren in PARENTHESES.finditer(block):
+        if paren.group() == '(':
+            opened.append(paren.start())
+        elif opened:
+            closing[opened.pop()] = paren.start()
+
+    return closing
+
+
+# already have a left parenthesis right before pos, find the matching right
+# parenthesis; only the parentheses after pos are looked at
+def findMatchingParenthsis(block, pos):
     depth = 1
 
-    for pos, ch in enumerate(block):
-        if ch == '(':
+    for paren in PARENTHESES.finditer(block, pos):
+        if paren.group() == '(':
             depth += 1
-        elif ch == ')':
+        else:
             depth -= 1
         if depth == 0:
-            return pos
+            return paren.start()
 
-    # failed case 
+    # failed case
     return -1
 
 
-# when a x.get_unchecked( or x.get_unchecked_mut( is found
-# Step 1: go back and replace the handle with regex
-# Step 2: go forward and find matching parenthesis, replace it as "])"
-# Step 3: convert whatever is inside
-def convertBlock(block, regex_in, regex_out, cur_line=1, selective_safe=[], make_selective_unsafe=False):
-    bcs = []
-    new_block = ""
-
-    # block == file
-    # need finer re matching granularity, because some functions may not be 
-    # converted in this file
-
-    # convert all instances of regex_in (per line) one at a time
-    while (match := re.search(regex_in, block)): 
-        # put whatever before in it 
-        pre_block = block[:match.span()[0]]
-        cur_block = block[match.span()[0]:match.span()[1]]
-        post_block = block[match.span()[1]:]
-
-        # handle within function call
-        # foo(xx.get_uncheck(
-        right = 0
-        for idx in reversed(range(len(cur_block) - 1)): # exclude the last '('
-            if cur_block[idx] == ')':
-                right += 1
-            if cur_block[idx] == '(':
-                right -= 1
-            if right < 0:
-                # found function start
-                pre_block += cur_block[:idx+1]
-                cur_block = cur_block[idx + 1:]
+# offsets at which the lines of block start; line n of the block starts at
+# line_starts[n - 1]
+def lineStarts(block):
+    return [0] + [newline.end() for newline in re.finditer('\n', block)]
+
+
+# resolve the (line_start, col_start, line_end, col_end) spans of the
+# mir-filelist to the calls they cover: the call whose ')' ends the span, or
+# else the first call that starts in it
+# returns {start of the call: (match, position of its ')')}
+def findTargets(block, pattern, line_starts, cur_line, spans):
+    targets = dict()
+
+    for (line_start, col_start, line_end, col_end) in spans:
+        if not (0 <= line_start - cur_line <= line_end - cur_line < len(line_starts)):
+            continue
+        start = line_starts[line_start - cur_line] + col_start - 1
+        end = line_starts[line_end - cur_line] + col_end - 1
+
+        target = None
+        for match in pattern.finditer(block, start, end):
+            pos = findMatchingParenthsis(block, match.end())
+            if pos == end - 1:
+                target = (match, pos)
                 break
+            if target == None:
+                target = (match, pos)
 
-        # calculate line and col
-        skipped_lines = pre_block.count('\n')
-        cur_line += skipped_lines
+        if target:
+            targets[target[0].start()] = target
 
-        # the column number of the starting point of old block
-        old_col = pre_block.rfind('\n')
-        if old_col == -1:
-            old_col = len(pre_block) + 1
-        else:
-            old_col = len(pre_block) - old_col
+    return targets
+
+
+# the (line_start, col_start, line_end, col_end) spans, as in a
+# mir-filelist, of the calls that a conversion without one converts in
+# block, from the '.' of each call to its ')'; findTargets resolves them
+# back to exactly these calls
+def findCallSpans(block):
+    pattern = re.compile("|".join(rin for (kind, rin, rout) in RULES))
+    line_starts = lineStarts(block)
+    closing = matchParentheses(block)
+    spans = []
+
+    for match in pattern.finditer(block):
+        close = closing.get(match.end() - 1)
+        # not a call that is converted, e.g. self.get_unchecked()
+        if close == None or close == match.end():
+            continue
+        line_start = bisect.bisect_right(line_starts, match.start())
+        line_end = bisect.bisect_right(line_starts, close)
+        spans.append((line_start, match.start() - line_starts[line_start - 1] + 1,
+            line_end, close - line_starts[line_end - 1] + 2))
+
+    return spans
+
+
+# when a x.get_unchecked( or x.get_unchecked_mut( is found
+# Step 1: replace the handle with the regex_out of the rule that matched
+# Step 2: find the matching parenthesis, replace it as ").unwrap()"
+# Step 3: convert whatever is inside
+# The output is built from a list of slices, and converted calls whose
+# arguments are still being walked sit on an explicit stack until the cursor
+# passes their closing parenthesis.
+# rules is [(kind, regex_in, regex_out), ...]; all of them are matched at
+# once and the bounds checks come back as [(line, col, kind), ...], grouped
+# by kind in the order of the rules, where col is the column of the '(' of
+# the converted call in the new block
+# selective_safe holds the spans of the calls to convert; the rewriter seeks
+# straight to them instead of scanning the whole block. With
+# make_selective_unsafe the block is scanned and every call except those is
+# converted.
+def convertBlock(block, rules, cur_line=1, selective_safe=[], make_selective_unsafe=False):
+    regex_in = "|".join("(?P<%s>%s)" % (kind, rin) for (kind, rin, rout) in rules)
+    pattern = re.compile(regex_in)
+    patterns = { kind: (re.compile(rin), rout) for (kind, rin, rout) in rules }
+    line_starts = lineStarts(block)
+    targets = findTargets(block, pattern, line_starts, cur_line, selective_safe)
+
+    if make_selective_unsafe:
+        closing = matchParentheses(block)
+        matches = pattern.finditer(block)
+    else:
+        matches = [match for (start, (match, pos)) in sorted(targets.items())]
 
+    bcs = []
+    new_block = []
+    # everything before cursor is already in new_block, which is out_len
+    # long and whose last line starts at out_line
+    cursor = out_len = out_line = 0
+    # converted calls that are not closed yet: [(close, line, col, kind), ...]
+    stack = []
+
+    def emit(text):
+        nonlocal out_len, out_line
+        newline = text.rfind('\n')
+        if newline != -1:
+            out_line = out_len + newline + 1
+        out_len += len(text)
+        new_block.append(text)
+
+    # replace the right parenthesis of a converted call and record the
+    # bounds check
+    def closeCall(call):
+        nonlocal cursor
+        pos, line, col, kind = call
+        emit(block[cursor:pos])
+        # emit("])")  # use the right parenthesis
+        emit(").unwrap()")  # use the right parenthesis
+        bcs.append((line, col, kind))
+        cursor = pos + 1
+
+    for match in matches:
+        start, end = match.span()
+
+        # close the converted calls that end before this match
+        while stack and stack[-1][0] < start:
+            closeCall(stack.pop())
+
+        cur = bisect.bisect_right(line_starts, start) - 1 + cur_line
+
+        # find match parenthesis
         if make_selective_unsafe:
-            if cur_line in selective_safe: # treat like selective_unsafe
-                new_block += pre_block + cur_block
-                block = post_block
+            if start in targets: # treat like selective_unsafe
                 continue
+            pos = closing.get(end - 1, -1)
         else:
-            # if choose not to convert this line to safe
-            if not cur_line in selective_safe:
-                #print(cur_line)
-                new_block += pre_block + cur_block
-                block = post_block
-                continue
+            pos = targets[start][1]
 
-        # find match parenthesis in post_block
-        pos = findMatchingParenthsis(post_block)
         # self.get_unchecked() syntax, need to ignore
-        if pos == 0: 
-            new_block += pre_block + cur_block
-            block = post_block
+        if pos == end:
             continue
 
         if pos == -1:
-            print("No enclosing parenthesis found, Line %d" % (cur_line))
+            print("No enclosing parenthesis found, Line %d" % (cur))
             return None, None
 
         # replace with the safe syntax
-        cur_block = re.sub(regex_in, regex_out, cur_block, count=1)
-        new_col = old_col + len(cur_block) - 1
-
-        new_middle_block, addition_bcs = convertBlock(post_block[:pos], regex_in, regex_out, cur_line, selective_safe, make_selective_unsafe)
-
-        # add bounds checks from the middle block to the bcs
-        if addition_bcs is None:
-            return None, None
-        else:
-            bcs.extend(addition_bcs)
-
-        # update new block
-        # new_block += pre_block + cur_block + new_middle_block + "])"  # use the right parenthesis
-        new_block += pre_block + cur_block + new_middle_block + ").unwrap()"  # use the right parenthesis
-
-        # update block
-        block = post_block[pos + 1:]
+        kind = match.lastgroup
+        rule, regex_out = patterns[kind]
+        emit(block[cursor:start])
+        emit(rule.sub(regex_out, match.group(), count=1))
+        cursor = end
 
-        # update bcs
-        bcs.append((cur_line, new_col))
+        # whatever is inside is converted before the call is closed
+        stack.append((pos, cur, out_len - out_line, kind))
 
-        # might have skipped several lines in the middle block
-        skipped_lines = new_middle_block.count('\n')
-        cur_line += skipped_lines
+    while stack:
+        closeCall(stack.pop())
 
     # append whatever is left in the block
-    new_block += block
+    emit(block[cursor:])
 
-    return new_block, bcs
+    # keep the per-rule order of one scan per rule
+    order = [kind for (kind, rin, rout) in rules]
+    bcs.sort(key=lambda bc: order.index(bc[2]))
+
+    return "".join(new_block), bcs
 
 
 def argParse():
@@ -295,12 +665,45 @@ def argParse():
             default="changes.txt",
             help="name of the file in which to store line/column/filename of changes; "\
                     "default is 'changes.txt' in the specified root dir")
+    parser.add_argument("--cache-dir", "-c",
+            metavar="path",
+            type=str,
+            help="directory of a persistent conversion cache; files whose content and "\
+                    "target spans were converted before are not parsed again")
+    parser.add_argument("--jobs", "-j",
+            metavar="N",
+            type=int,
+            default=1,
+            help="number of worker processes to convert files with; "\
+                    "default is 1 (convert one file after another)")
+    parser.add_argument("--site-db", "-d",
+            metavar="filename",
+            type=str,
+            help="SQLite database in which to also record the converted sites, "\
+                    "with their kind, enclosing function and conversion strategy")
+    parser.add_argument("--crate",
+            metavar="name",
+            type=str,
+            help="name of the crate the sites are recorded under in the site "\
+                    "database; default is the name of the root dir")
+    parser.add_argument("--dry-run", "-n",
+            action="store_true",
+            help="report the number of edits per file without writing anything")
     args = parser.parse_args()
-    return args.root, args.logfile, args.mir_filelist
+    return args.root, args.logfile, args.mir_filelist, args.jobs, args.cache_dir, \
+            args.site_db, args.crate, args.dry_run
 
 
 if __name__ == "__main__":
-    root, logfile, mir_filelist = argParse()
+    root, logfile, mir_filelist, num_jobs, cache_dir, site_db, crate, dry_run = argParse()
+    # the cache and the database may be given relative to where we were
+    # called from
+    if cache_dir:
+        cache_dir = os.path.abspath(cache_dir)
+    if site_db:
+        site_db = os.path.abspath(site_db)
+    if not crate:
+        crate = os.path.basename(os.path.abspath(root))
     os.chdir(root)
 
     # vendor
@@ -317,12 +720,9 @@ if __name__ == "__main__":
     #os.environ["RUSTFLAGS"] = "-Z convert-unchecked-indexing"
     #mir_filelist = subprocess.run(["cargo", "bench", "--no-run"], capture_output=True, text=True)
 
-    bcs = []
-
     if mir_filelist == None:
         filelist = findTargetFilesOld()
-        for f in filelist:
-            bcs.extend(convertFile(f, f, [], make_selective_unsafe=True))
+        jobs = [(f, f, [], True) for f in filelist]
     else:
         if "mozilla" in root: 
             #patchAll(".", "vendor", "vendor")
@@ -335,9 +735,16 @@ if __name__ == "__main__":
         #    print(f)
         #print()
     
-        # List of all bounds checks
-        for fname in filelist.keys():
-            bcs.extend(convertFile(fname, fname, filelist[fname]))
+        jobs = [(fname, fname, spans, False) for fname, spans in filelist.items()]
 
-    dumpBCs(bcs, logfile)
+    # List of all bounds checks
+    bcs = convertFiles(jobs, num_jobs, cache_dir, dry_run)
+
+    if dry_run:
+        print("%d edits in %d files" % (len(bcs), len(set(bc[2] for bc in bcs))))
+    else:
+        dumpBCs(bcs, logfile)
+        if site_db:
+            strategy = "all" if mir_filelist == None else "mir-filelist"
+            record_sites(site_db, crate, bcs, strategy)
 
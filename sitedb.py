@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# Indexed store of the bounds-check sites converted by regexify
+#
+# One row per converted site, across all crates of a campaign, so that
+# questions like "which dependency contributes the most converted sites" are
+# indexed queries instead of walks over every crate's changes.txt.
+import os
+import sys
+import argparse
+import sqlite3
+
+VENDOR_DIR = "vendor"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sites (
+    crate TEXT NOT NULL,
+    package TEXT NOT NULL,
+    file TEXT NOT NULL,
+    line INTEGER NOT NULL,
+    col INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    function TEXT,
+    strategy TEXT NOT NULL,
+    PRIMARY KEY (crate, file, line, col)
+);
+CREATE INDEX IF NOT EXISTS sites_package ON sites (package, crate);
+CREATE INDEX IF NOT EXISTS sites_function ON sites (function, crate);
+"""
+
+def connect(db_path):
+    directory = os.path.dirname(db_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    # several crates may be converted at the same time
+    db = sqlite3.connect(db_path, timeout=60)
+    db.executescript(SCHEMA)
+    return db
+
+def package_of(crate, fname):
+    """ Sites in vendor/<dep>/... belong to the vendored dependency,
+    everything else to the crate itself
+    """
+    parts = fname.split("/")
+    if len(parts) > 2 and parts[0] == VENDOR_DIR:
+        return parts[1]
+    return crate
+
+def record_sites(db_path, crate, bcs, strategy):
+    """ Replace the sites recorded for crate with bcs, a list of
+    (line, col, fname, kind, function) as returned by regexify
+    """
+    rows = []
+    for (line, col, fname, kind, function) in bcs:
+        # get rid of the initial "./"
+        if fname.startswith("./"):
+            fname = fname[2:]
+        rows.append((crate, package_of(crate, fname), fname, line, col,
+            kind, function, strategy))
+
+    db = connect(db_path)
+    with db:
+        db.execute("DELETE FROM sites WHERE crate = ?", (crate,))
+        db.executemany("INSERT OR REPLACE INTO sites VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    db.close()
+
+def add_vendored_sites(db_path, crate, package, entry_db):
+    """ Record the sites of package, a dependency converted once for several
+    crates (with its own entry_db, if any site was converted in it), as
+    sites of crate, like those of its vendor/<package>
+    """
+    rows = []
+    if os.path.exists(entry_db):
+        db = sqlite3.connect(entry_db, timeout=60)
+        for (fname, line, col, kind, function, strategy) in db.execute(
+                "SELECT file, line, col, kind, function, strategy FROM sites"):
+            rows.append((crate, package, "/".join([VENDOR_DIR, package, fname]), line, col,
+                kind, function, strategy))
+        db.close()
+
+    db = connect(db_path)
+    with db:
+        db.execute("DELETE FROM sites WHERE crate = ? AND package = ?", (crate, package))
+        db.executemany("INSERT OR REPLACE INTO sites VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    db.close()
+
+def converted_packages(db_path, crate):
+    """ The dependencies of crate in which sites were converted
+    """
+    db = connect(db_path)
+    rows = db.execute("SELECT DISTINCT package FROM sites WHERE crate = ? "
+        "AND package != crate ORDER BY package", (crate,)).fetchall()
+    db.close()
+    return [package for (package,) in rows]
+
+def sites_per_package(db_path, dependencies_only=True):
+    """ [(package, number of sites, number of crates it was converted in)],
+    most sites first
+    """
+    where = "WHERE package != crate" if dependencies_only else ""
+    db = connect(db_path)
+    rows = db.execute("SELECT package, COUNT(*), COUNT(DISTINCT crate) FROM sites "
+        "{} GROUP BY package ORDER BY 2 DESC, 1".format(where)).fetchall()
+    db.close()
+    return rows
+
+def sites_per_function(db_path, functions=None):
+    """ [(crate, function, number of sites)], most sites first; restricted
+    to the given function names (e.g. those hit by the benchmarks) if any
+    """
+    query = "SELECT crate, function, COUNT(*) FROM sites"
+    params = []
+    if functions:
+        query += " WHERE function IN ({})".format(", ".join("?" * len(functions)))
+        params = list(functions)
+    query += " GROUP BY crate, function ORDER BY 3 DESC, 1, 2"
+    db = connect(db_path)
+    rows = db.execute(query, params).fetchall()
+    db.close()
+    return rows
+
+def print_row(array):
+    print("\t".join(str(elem) for elem in array))
+
+def arg_parse():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", "-d",
+        metavar="filename",
+        type=str,
+        required=True,
+        help="site database written by regexify --site-db")
+    parser.add_argument("--packages", "-p",
+        action="store_true",
+        help="list the dependencies by number of converted sites")
+    parser.add_argument("--functions", "-f",
+        metavar="filename",
+        type=str,
+        nargs="?",
+        const="",
+        help="list the number of converted sites per function; restricted "\
+            "to the function names listed (one per line) in filename if given")
+    args = parser.parse_args()
+    return args.db, args.packages, args.functions
+
+if __name__ == "__main__":
+    db_path, packages, functions = arg_parse()
+    if not os.path.exists(db_path):
+        sys.exit("No such database: {}".format(db_path))
+
+    if packages:
+        print_row(["#", "package", "sites", "crates"])
+        for row in sites_per_package(db_path):
+            print_row(row)
+    if functions != None:
+        names = None
+        if functions:
+            with open(functions, "r") as fd:
+                names = [line.strip() for line in fd if line.strip()]
+        print_row(["#", "crate", "function", "sites"])
+        for row in sites_per_function(db_path, names):
+            print_row(row)
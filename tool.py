@@ -1,47 +1,272 @@
 #!/usr/bin/env python
 
 import os
+import re
 import sys
 import argparse
+import json
+import gzip
+import fcntl
+import shutil
+import hashlib
+import tempfile
 import subprocess
 from make_patch import patchAll
+from regexify import MIR_SPAN
+from sitedb import add_vendored_sites
+from mirror import fetch_all
 import random
+import signal
+import time
 import datetime
-from aggregate import dump_benchmark, path_wrangle, writerow
+import threading
+from statistics import median
+from aggregate import dump_benchmark, dump_estimates, dump_results, path_wrangle, writerow, \
+    StreamParser, write_result, read_results, exact_filter
 import numpy
-from crunch import stats2
+from crunch import stats, stats2, ci95
 from result_presenter_fig1 import gen_figure1
 
 ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
 VENDOR_DIR = "vendor"
 COMP_LOG = "compile.log"
+# cargo's JSON messages, and the bench executables found in them (in target/)
+CARGO_MESSAGES = "cio-cargo-messages.json"
+BENCH_EXES = "cio-bench-executables.json"
+# per-benchmark outputs of an interleaved run (in the run dir)
+INTERLEAVED = "interleaved"
+NOISY_RERUNS = 3
+# output of the runs of an earlier version, before it was streamed
 RUN_OUT = "run.out"
+RUN_LOG = "run.out.gz"
+RUN_RESULTS = "run.results"
 RUN_ERR = "run.err"
 RUN_PARSED = "run.parsed"
+RUN_SAMPLES = "run.samples.json"
+# copy of the criterion results of a run (in the run dir)
+CRITERION_SNAPSHOT = "criterion"
 UNSAFE_DIR = os.path.join(ROOT_PATH, "unsafe-crates")
 SAFE_DIR = os.path.join(ROOT_PATH, "safe-crates")
+MIRROR_DIR = os.path.join(ROOT_PATH, "crate-mirror")
+VENDOR_STORE = os.path.join(ROOT_PATH, "vendor-store")
 EXP_DIRS = [UNSAFE_DIR, SAFE_DIR]
 RESULTS = "results"
+REGEXIFY_CACHE = os.path.join(ROOT_PATH, "regexify-cache")
 CRUNCHED = "crunched.data"
+SITE_DB = "sites.db"
+FINGERPRINT = "cio-fingerprint.json"
+MIR_FINGERPRINT = "mir-filelist.fingerprint"
+# spans of the mir-filelist in the shared vendor store, per dependency
+MIR_DEPS = "mir-filelist.deps.json"
+# Outputs of the tool itself, which are not inputs of the build
+NOT_INPUTS = [COMP_LOG, "mir-filelist", MIR_FINGERPRINT, MIR_DEPS, "changes.txt", 
+    "bisect.log", "hot-sites.txt", "timeouts", "target"]
+MANIFEST = "manifest.json"
+# The stages of a campaign, each depending on the previous one
+STAGES = ["download", "rust-version", "convert", "compile", "run", "aggregate"]
+DONE = "done"
+FAILED = "failed"
 HEADERS = ['#', 'bench-name', 'unmod-time', 'unmod-error', 'regex-time', 'regex-error']
+# ioctl that makes a file share the extents of another (linux/fs.h)
+FICLONE = 0x40049409
+NODE_DIR = "/sys/devices/system/node"
+# Files that are edited in place, and so cannot be shared between copies
+EDITED_IN_PLACE = ["Cargo.toml", "Cargo.lock"]
+
+# "0-3,8,10-11" -> [0, 1, 2, 3, 8, 10, 11]
+def parse_cpulist(cpulist):
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if not part: 
+            continue
+        first, _, last = part.partition("-")
+        cpus += range(int(first), int(last or first) + 1)
+    return cpus
+
+# Clone the crate(s) in <src> into <dst> without copying their contents: 
+# files are reflinked where the filesystem supports it and hardlinked 
+# otherwise. regexify replaces the files it converts instead of writing 
+# them in place, which is what breaks their link, and leaves the others 
+# alone, so only the converted files take up space of their own. 
+def clone_tree(src, dst):
+    reflink = True
+    for root, dirs, files in os.walk(src):
+        rel_root = os.path.relpath(root, src)
+        # build output of the crate (or workspace)
+        if "Cargo.toml" in files and "target" in dirs: 
+            dirs.remove("target")
+        os.makedirs(os.path.join(dst, rel_root), exist_ok=True)
+        in_place = ".cargo" in rel_root.split(os.sep)
+        for fname in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            src_file = os.path.join(root, fname)
+            dst_file = os.path.join(dst, rel_root, fname)
+            if os.path.islink(src_file): 
+                os.symlink(os.readlink(src_file), dst_file)
+            elif in_place or fname in EDITED_IN_PLACE: 
+                shutil.copy2(src_file, dst_file)
+            else: 
+                if reflink: 
+                    try: 
+                        with open(src_file, "rb") as src_fd, open(dst_file, "wb") as dst_fd: 
+                            fcntl.ioctl(dst_fd.fileno(), FICLONE, src_fd.fileno())
+                        shutil.copystat(src_file, dst_file)
+                        continue
+                    except OSError: 
+                        # not supported here, no use trying the other files
+                        if os.path.exists(dst_file): 
+                            os.unlink(dst_file)
+                        reflink = False
+                try: 
+                    os.link(src_file, dst_file)
+                except OSError: 
+                    # e.g. on another filesystem
+                    shutil.copy2(src_file, dst_file)
 
 class CIO:
 
-    def __init__(self, crates, rust_version, vendor, num_runs):
+    def __init__(self, crates, rust_version, vendor, num_runs, jobs=None, mem_cap=None, shared_cache=None, 
+            bench_cache=None, incremental=False, resume=False, mirror=None, shared_vendor=False, 
+            run_jobs=None, min_runs=None, ci_width=None, interleave=False, rerun_cv=None):
         self.rust_version = "mod" if rust_version == None else "nightly-{}".format(rust_version)
         self.raw_results = "{}-{}".format(RESULTS, self.rust_version)
         self.agg_results = os.path.join(ROOT_PATH, self.raw_results)
-        self.vendor = vendor
+        self.shared_vendor = shared_vendor
+        self.vendor = vendor or shared_vendor
         self.num_runs = 10 if num_runs == None else num_runs
+        # Adaptive mode: <self.num_runs> is the maximum number of runs, a crate
+        # stops after <self.min_runs> or more once the 95% CI of every safe/unsafe
+        # ratio is narrower than <self.ci_width>
+        self.ci_width = ci_width
+        self.min_runs = 5 if min_runs == None else min(min_runs, self.num_runs)
+        self.jobs = 1 if jobs == None else jobs
+        self.run_jobs = 1 if run_jobs == None else run_jobs
+        self.interleave = interleave
+        self.rerun_cv = 0.05 if rerun_cv == None else rerun_cv
+        self.mem_cap = mem_cap
+        self.shared_cache = None
+        if shared_cache != None: 
+            if shutil.which("sccache") == None: 
+                print("sccache not found, building without a shared cache")
+            else: 
+                self.shared_cache = os.path.abspath(shared_cache)
+        self.bench_cache = None if bench_cache == None else os.path.abspath(bench_cache)
+        # crate -> key of its baseline, as it was before its build
+        self.baseline_keys = dict()
+        self.incremental = incremental
+        self.resume = resume
+        self.mirror = MIRROR_DIR if mirror == None else os.path.abspath(mirror)
         self.crates = crates
         self.crate_paths = []
         for crate in self.crates: 
             crate_path = crate.replace("/", "-")
             self.crate_paths.append(crate_path)
+        self.manifest = dict()
+        manifest = os.path.join(self.agg_results, MANIFEST)
+        if os.path.exists(manifest): 
+            with open(manifest, "r") as fd: 
+                self.manifest = json.load(fd)
+
+    # The manifest records, for every crate, the stages that completed 
+    # (and for "run", every run that did), so that a campaign that was 
+    # interrupted can be resumed where it stopped: 
+    #   {crate_path: {stage: "done"|"failed", "run": {run: "done"|"failed"}}}
+    #   ("converged": [run, ...] in "run" once the runs that had completed 
+    #   were enough for an adaptive crate)
+    def is_done(self, crate_path, stage, run=None):
+        status = self.manifest.get(crate_path, dict())
+        if stage == "run": 
+            runs = status.get("run", dict())
+            if run == None: 
+                return all(runs.get(str(run)) == DONE 
+                    for run in runs.get("converged", range(self.num_runs)))
+            return runs.get(str(run)) == DONE
+        return status.get(stage) == DONE
+
+    # The runs of crate_path that completed, including the reruns of noisy 
+    # benchmarks after them (all the runs if they were not recorded in the 
+    # manifest)
+    def completed_runs(self, crate_path):
+        runs = self.manifest.get(crate_path, dict()).get("run")
+        if not runs: 
+            return list(range(self.num_runs))
+        return [run for run in range(self.num_runs + NOISY_RERUNS) if runs.get(str(run)) == DONE]
+
+    # (a crate whose runs failed only in part still has the others to 
+    # aggregate, its run stage fails if none of them completed)
+    def is_failed(self, crate_path, stage):
+        status = self.manifest.get(crate_path, dict())
+        if stage == "run": 
+            return FAILED in status.get("run", dict()).values() and not self.completed_runs(crate_path)
+        return status.get(stage) == FAILED
+
+    def mark(self, crate_path, stage, ok, run=None):
+        status = self.manifest.setdefault(crate_path, dict())
+        if stage == "run": 
+            status.setdefault("run", dict())[str(run)] = DONE if ok else FAILED
+        else: 
+            status[stage] = DONE if ok else FAILED
+        # whatever was done downstream used the previous output of this stage
+        if ok: 
+            for later in STAGES[STAGES.index(stage) + 1:]: 
+                status.pop(later, None)
+        self.save_manifest()
+
+    def save_manifest(self):
+        subprocess.run(["mkdir", "-p", self.agg_results])
+        manifest = os.path.join(self.agg_results, MANIFEST)
+        with open(manifest + ".tmp", "w") as fd: 
+            json.dump(self.manifest, fd, indent=4, sort_keys=True)
+        os.replace(manifest + ".tmp", manifest)
+
+    # Run the given stages in order, each for the crates it has not been 
+    # done for yet when resuming and for all crates otherwise
+    def run_stages(self, stages, mod=False):
+        for stage in STAGES: 
+            if stage not in stages: 
+                continue
+            crate_paths = []
+            for crate_path in self.crate_paths: 
+                if self.resume and self.is_done(crate_path, stage): 
+                    continue
+                # nothing to build on
+                failed = [earlier for earlier in STAGES[:STAGES.index(stage)] 
+                    if self.is_failed(crate_path, earlier)]
+                if failed: 
+                    print("Skipping {} for {}, {} failed".format(stage, crate_path, failed[0]))
+                    continue
+                crate_paths.append(crate_path)
+            if not crate_paths: 
+                print("Skipping {}, nothing to do".format(stage))
+                continue
+
+            start = datetime.datetime.now()
+            if stage == "download": 
+                self.download_crates(crate_paths)
+            elif stage == "rust-version": 
+                self.set_rust_version(crate_paths)
+            elif stage == "convert": 
+                self.convert_to_safe(mod, crate_paths)
+            elif stage == "compile": 
+                self.compile_benchmarks(crate_paths)
+            elif stage == "run": 
+                self.run_benchmarks(crate_paths)
+            elif stage == "aggregate": 
+                self.aggregate_results(crate_paths)
+            end = datetime.datetime.now()
+
+            # Log duration
+            if stage in ["compile", "run"]: 
+                durfile = os.path.join(ROOT_PATH, 
+                    "duration-compile" if stage == "compile" else "duration-benchmark")
+                with open(durfile, "w") as fd: 
+                    fd.write("start:\t\t{}\n".format(start))
+                    fd.write("end:\t\t{}\n".format(end))
+                    fd.write("duration:\t{}\n".format(end - start))
+        os.chdir(ROOT_PATH)
 
-    def revert_criterion_version(self):
+    def revert_criterion_version(self, crate_paths):
         os.chdir(UNSAFE_DIR)
-        for crate_path in self.crate_paths: 
+        for crate_path in crate_paths: 
             os.chdir(crate_path)
             subprocess.run(["cargo", "rm", "criterion", "--dev"], 
                 stdout=open(os.devnull, 'wb'), stderr=open(os.devnull, 'wb'))
@@ -53,13 +278,172 @@ class CIO:
         print("Vendoring {}".format(crate_path))
         subprocess.run(["cargo", "vendor", "--versioned-dirs", VENDOR_DIR],
             stdout=open(os.devnull, 'wb'), stderr=open(os.devnull, 'wb'))
+        self.write_vendor_config(VENDOR_DIR)
+        patchAll(".", VENDOR_DIR, VENDOR_DIR)
+
+    # With a shared vendor store, every versioned dependency is vendored 
+    # once for all crates, into <VENDOR_STORE>/unsafe/<name-version>, and 
+    # converted once for each way of converting it (see convert_shared_deps). 
+    # The unsafe copy of a crate uses the store through its 
+    # .cargo/config.toml, the converted copy through its own vendor/, whose 
+    # entries link to the store, and both are patched with their own 
+    # dependencies only. 
+    def vendor_shared(self, crate_path):
+        unsafe_store = os.path.join(VENDOR_STORE, "unsafe")
+        os.makedirs(unsafe_store, exist_ok=True)
+        crate_dir = os.path.join(UNSAFE_DIR, crate_path)
+
+        deps = self.registry_deps(crate_dir)
+        missing = None if deps == None else \
+            [dep for dep in deps if not os.path.isdir(os.path.join(unsafe_store, dep))]
+        if missing != []: 
+            if missing == None: 
+                print("Vendoring {}".format(crate_path))
+            else: 
+                print("Vendoring {} ({} new dependencies)".format(crate_path, len(missing)))
+            tmp = tempfile.mkdtemp(dir=VENDOR_STORE, prefix=".vendor-")
+            subprocess.run(["cargo", "vendor", "--versioned-dirs", tmp], cwd=crate_dir,
+                stdout=open(os.devnull, 'wb'), stderr=open(os.devnull, 'wb'))
+            if deps == None: 
+                deps = sorted(os.listdir(tmp))
+                missing = [dep for dep in deps if not os.path.isdir(os.path.join(unsafe_store, dep))]
+            for dep in missing: 
+                try: 
+                    os.rename(os.path.join(tmp, dep), os.path.join(unsafe_store, dep))
+                except OSError: 
+                    # not vendored, or vendored by someone else in the meantime
+                    pass
+            shutil.rmtree(tmp)
+
+        os.chdir(crate_dir)
+        self.write_vendor_config(unsafe_store)
+        patchAll(".", unsafe_store, unsafe_store, deps=deps)
+        # the converted copy starts out with the unsafe dependencies, 
+        # convert_to_safe converts them along with the crate
+        os.chdir(os.path.join(SAFE_DIR, crate_path))
+        shutil.rmtree(VENDOR_DIR, ignore_errors=True)
+        os.mkdir(VENDOR_DIR)
+        for dep in deps: 
+            if os.path.isdir(os.path.join(unsafe_store, dep)): 
+                self.link_dep(VENDOR_DIR, dep, os.path.join(unsafe_store, dep))
+        self.write_vendor_config(VENDOR_DIR)
+        patchAll(".", VENDOR_DIR, VENDOR_DIR)
+
+    def write_vendor_config(self, directory):
         subprocess.run(["mkdir", "-p", ".cargo"])
         with open(".cargo/config.toml", 'a') as fd:
-            fd.write("[source.crates-io]\nreplace-with = \x22vendored-sources\x22\n\n[source.vendored-sources]\ndirectory = \x22{}\x22\n".format(VENDOR_DIR))
-        patchAll(".", VENDOR_DIR, VENDOR_DIR)
+            fd.write("[source.crates-io]\nreplace-with = \x22vendored-sources\x22\n\n[source.vendored-sources]\ndirectory = \x22{}\x22\n".format(directory))
+
+    # <name-version> of the crates.io packages that crate_dir depends on, 
+    # as named by cargo vendor --versioned-dirs (None if cargo cannot tell)
+    def registry_deps(self, crate_dir):
+        ret = subprocess.run(["cargo", "metadata", "--format-version", "1"], cwd=crate_dir,
+            capture_output=True, text=True)
+        if ret.returncode != 0: 
+            return None
+        packages = json.loads(ret.stdout)["packages"]
+        return sorted("{}-{}".format(package["name"], package["version"]) for package in packages 
+            if (package["source"] or "").startswith("registry+"))
+
+    # (Re)points <vendor_dir>/<dep> at <target>, atomically
+    def link_dep(self, vendor_dir, dep, target):
+        link = os.path.join(vendor_dir, dep)
+        if os.path.lexists(link + ".tmp"): 
+            os.unlink(link + ".tmp")
+        os.symlink(target, link + ".tmp")
+        os.replace(link + ".tmp", link)
+
+    # Converts the dependencies in the shared store of the converted copy 
+    # of <crate_path> the way the crate itself is converted: entirely, 
+    # without <dep_filelists>, or at the mir-filelist lines of each 
+    # dependency in <dep_filelists> (see split_filelist). Each way has an 
+    # entry of its own, <VENDOR_STORE>/safe/all/<dep> or 
+    # <VENDOR_STORE>/safe/mir-<digest of the lines>/<dep>, converted by the 
+    # first crate that needs it, and vendor/<dep> is linked to it. 
+    # Dependencies without any lines stay linked to their unsafe copy. 
+    # The sites of an entry, kept in its own site db, are recorded as 
+    # sites of the crate in vendor/<dep>. 
+    # Returns False if any dependency failed to convert.
+    def convert_shared_deps(self, crate_path, dep_filelists=None):
+        vendor_dir = os.path.join(SAFE_DIR, crate_path, VENDOR_DIR)
+        ok = True
+        for dep in sorted(os.listdir(vendor_dir)): 
+            lines = None
+            if dep_filelists == None: 
+                entry = os.path.join(VENDOR_STORE, "safe", "all", dep)
+            elif dep in dep_filelists: 
+                lines = dep_filelists[dep]
+                digest = hashlib.sha256("".join(lines).encode()).hexdigest()[:16]
+                entry = os.path.join(VENDOR_STORE, "safe", "mir-" + digest, dep)
+            else: 
+                entry = os.path.join(VENDOR_STORE, "unsafe", dep)
+            if not os.path.isdir(entry) and not self.store_dep(dep, entry, lines): 
+                print("Converting {} failed".format(dep))
+                ok = False
+                continue
+            self.link_dep(vendor_dir, dep, entry)
+            add_vendored_sites(os.path.join(self.agg_results, SITE_DB), crate_path, dep, 
+                os.path.join(entry, SITE_DB))
+        return ok
+
+    # Converts the unsafe copy of <dep> into the store <entry>, only at the 
+    # mir-filelist <lines> if any, with the sites it converts in the 
+    # entry's own SITE_DB. A failed conversion leaves no entry.
+    def store_dep(self, dep, entry, lines=None):
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        # converted in a temp dir first, so that an entry is complete
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(entry), prefix=".convert-")
+        clone_tree(os.path.join(VENDOR_STORE, "unsafe", dep), os.path.join(tmp, dep))
+        cmd = ["python3", os.path.join(ROOT_PATH, "regexify.py"), "--root", os.path.join(tmp, dep), 
+            "--cache-dir", os.path.join(REGEXIFY_CACHE, dep),
+            "--site-db", os.path.join(tmp, dep, SITE_DB), "--crate", dep]
+        if lines != None: 
+            with open(os.path.join(tmp, "mir-filelist"), "w") as fd: 
+                fd.writelines(lines)
+            cmd += ["--mir-filelist", os.path.join(tmp, "mir-filelist")]
+        ret = subprocess.run(cmd, stdout=open(os.devnull, 'wb'))
+        if ret.returncode == 0: 
+            try: 
+                os.rename(os.path.join(tmp, dep), entry)
+            except OSError: 
+                # converted by someone else in the meantime
+                pass
+        shutil.rmtree(tmp)
+        return ret.returncode == 0
+
+    # The mir-filelist of a crate that uses the shared store also has the 
+    # spans in its dependencies, which resolve into <VENDOR_STORE>/unsafe 
+    # and must not be converted in place. They are moved into MIR_DEPS, 
+    # as {dep: [lines]} with paths relative to the dependency, and 
+    # mir-filelist keeps the crate's own. 
+    def split_filelist(self):
+        unsafe_store = os.path.realpath(os.path.join(VENDOR_STORE, "unsafe"))
+        own = []
+        dep_filelists = dict()
+        with open("mir-filelist", "r") as fd: 
+            for line in fd: 
+                m = MIR_SPAN.match(line)
+                path = os.path.realpath(m.group(1).strip()) if m else ""
+                if not path.startswith(unsafe_store + os.sep): 
+                    own.append(line)
+                    continue
+                dep, _, rel = os.path.relpath(path, unsafe_store).partition(os.sep)
+                dep_filelists.setdefault(dep, []).append(rel + line[m.end(1):].rstrip("\n") + "\n")
+        for dep in dep_filelists: 
+            dep_filelists[dep].sort()
+        with open("mir-filelist.tmp", "w") as fd: 
+            fd.writelines(own)
+        os.replace("mir-filelist.tmp", "mir-filelist")
+        with open(MIR_DEPS + ".tmp", "w") as fd: 
+            json.dump(dep_filelists, fd)
+        os.replace(MIR_DEPS + ".tmp", MIR_DEPS)
+        return dep_filelists
 
     def vendor_deps(self, crate=None):
-        if crate == None: 
+        if self.shared_vendor: 
+            for crate_path in (self.crate_paths if crate == None else [crate]): 
+                self.vendor_shared(crate_path)
+        elif crate == None: 
             for DIR in EXP_DIRS:
                 os.chdir(DIR)
                 for crate_path in self.crate_paths:
@@ -73,43 +457,61 @@ class CIO:
 
     # Rustup directory override is not carried by copy, 
     # must be done for each directory individually
-    def set_rust_version(self):
-        for DIR in EXP_DIRS:
-            os.chdir(DIR)
-            for crate_path in self.crate_paths:
-                subprocess.run(["rustup", "override", "set", self.rust_version],
+    def set_rust_version(self, crate_paths=None):
+        crate_paths = self.crate_paths if crate_paths == None else crate_paths
+        for crate_path in crate_paths:
+            ok = True
+            for DIR in EXP_DIRS:
+                ret = subprocess.run(["rustup", "override", "set", self.rust_version],
+                    cwd=os.path.join(DIR, crate_path),
                     stdout=open(os.devnull, 'wb'), stderr=open(os.devnull, 'wb'))
+                ok = ok and ret.returncode == 0
+            self.mark(crate_path, "rust-version", ok)
 
-    def download_crates(self):
+    def download_crates(self, crate_paths=None):
+        crate_paths = self.crate_paths if crate_paths == None else crate_paths
         subprocess.run(["mkdir", "-p", UNSAFE_DIR])
         os.chdir(UNSAFE_DIR)
-        for crate in self.crates: 
-            print("Downloading {}".format(crate.replace("/", "-")))
-            subprocess.run(["wget", "https://crates.io/api/v1/crates/{}/download".format(crate)],
-                stdout=open(os.devnull, 'wb'), stderr=open(os.devnull, 'wb'))
-            subprocess.run(["tar", "-xf", "download"])
-            subprocess.run(["rm", "download"])
+        # Only the crates missing from the mirror are actually downloaded
+        crates = [crate for crate in self.crates if crate.replace("/", "-") in crate_paths]
+        print("Downloading {} crates through {}".format(len(crates), self.mirror))
+        failed = set()
+        for crate, err in fetch_all(self.mirror, crates, UNSAFE_DIR).items(): 
+            if err != None: 
+                print("Downloading {} failed: {}".format(crate.replace("/", "-"), err))
+                failed.add(crate.replace("/", "-"))
+        crate_paths = [crate_path for crate_path in crate_paths if crate_path not in failed]
 
         # Set the correct criterion version
         # in UNSAFE_DIR (will just be copied to SAFE_DIR)
-        self.revert_criterion_version()
+        self.revert_criterion_version(crate_paths)
 
         # If SAFE_DIR already exists, copy crates over
         # individually from UNSAFE_DIR
         if os.path.isdir(SAFE_DIR):
-            for crate_path in self.crate_paths:
-                subprocess.run(["cp", "-r", crate_path, os.path.join(SAFE_DIR, crate_path)])
+            for crate_path in crate_paths:
+                # a crate downloaded again replaces its old copy
+                subprocess.run(["rm", "-rf", os.path.join(SAFE_DIR, crate_path)])
+                clone_tree(crate_path, os.path.join(SAFE_DIR, crate_path))
                 # Vendor dependencies
                 if self.vendor: 
                     self.vendor_deps(crate_path)
         # Otherwise, copy the entire UNSAFE_DIR into (new) SAFE_DIR
         else: 
-            subprocess.run(["cp", "-r", UNSAFE_DIR, SAFE_DIR])
+            clone_tree(UNSAFE_DIR, SAFE_DIR)
             # Vendor dependencies
             if self.vendor:
-                self.vendor_deps()
+                for crate_path in crate_paths: 
+                    self.vendor_deps(crate_path)
+
+        for crate_path in crate_paths: 
+            self.mark(crate_path, "download", 
+                all(os.path.isdir(os.path.join(DIR, crate_path)) for DIR in EXP_DIRS))
+        for crate_path in failed: 
+            self.mark(crate_path, "download", False)
 
-    def convert_to_safe(self, mod=False):
+    def convert_to_safe(self, mod=False, crate_paths=None):
+        crate_paths = self.crate_paths if crate_paths == None else crate_paths
         # If our modified rustc is used we can rely on the 
         # generated 'mir-filelist' file for converting 
         # unchecked indexing
@@ -117,57 +519,447 @@ class CIO:
             safe_crate_dir = os.path.join(ROOT_PATH, "safe-crates")
             mir_filelist = "/exploreunsafe/mir-filelist"
             os.chdir(safe_crate_dir)
-            for crate_path in self.crate_paths:
-                print("Collecting unchecked indexing ops to convert for {}".format(crate_path))
+            for crate_path in crate_paths:
                 os.chdir(crate_path)
+                # The crate is left as converted by the last run: if it 
+                # has not changed since, there is nothing to convert (and 
+                # converting it again would find no sites left to record)
+                if self.converted_unchanged(crate_path, mod=True): 
+                    self.mark(crate_path, "convert", True)
+                    os.chdir(safe_crate_dir)
+                    continue
+                print("Collecting unchecked indexing ops to convert for {}".format(crate_path))
+                dep_filelists = None
+                if self.shared_vendor: 
+                    # collected from the unsafe dependencies
+                    self.convert_shared_deps(crate_path, dict())
                 subprocess.run(["rm", "-f", mir_filelist])
                 subprocess.run(["cargo", "clean"])
                 subprocess.run(["cargo", "bench", "--verbose", "--no-run"],
                     stdout=open(os.devnull, 'wb'), stderr=open(os.devnull, 'wb'))
                 subprocess.run(["mv", mir_filelist, "mir-filelist"])
                 subprocess.run(["cargo", "clean"])
+                if self.shared_vendor: 
+                    dep_filelists = self.split_filelist()
                 print("Converting {}".format(crate_path))
-                subprocess.run(["python3", "../../regexify.py", "--root", 
-".", "--mir-filelist", "mir-filelist"])
+                ret = subprocess.run(["python3", "../../regexify.py", "--root", 
+".", "--mir-filelist", "mir-filelist", 
+                    "--cache-dir", os.path.join(REGEXIFY_CACHE, crate_path),
+                    "--site-db", os.path.join(self.agg_results, SITE_DB), "--crate", crate_path])
+                ok = ret.returncode == 0
+                if self.shared_vendor: 
+                    ok = self.convert_shared_deps(crate_path, dep_filelists) and ok
+                if self.incremental: 
+                    self.write_fingerprint(MIR_FINGERPRINT, self.fingerprint("."))
+                self.mark(crate_path, "convert", ok)
                 os.chdir(safe_crate_dir)
         # For all other rustc versions we 
         # solely rely on our regexify implementation
         else: 
             safe_crate_dir = os.path.join(ROOT_PATH, "safe-crates")
             os.chdir(safe_crate_dir)
-            for crate_path in self.crate_paths:
+            for crate_path in crate_paths:
                 os.chdir(crate_path)
-                subprocess.run(["cargo", "clean"])
+                if self.converted_unchanged(crate_path): 
+                    self.mark(crate_path, "convert", True)
+                    os.chdir(safe_crate_dir)
+                    continue
+                # compile_benchmarks cleans the crate if the conversion changes it
+                if not self.incremental: 
+                    subprocess.run(["cargo", "clean"])
                 print("Converting {}".format(crate_path))
-                subprocess.run(["python3", "../../regexify.py", "--root", "."])
+                ret = subprocess.run(["python3", "../../regexify.py", "--root", ".", 
+                    "--cache-dir", os.path.join(REGEXIFY_CACHE, crate_path),
+                    "--site-db", os.path.join(self.agg_results, SITE_DB), "--crate", crate_path])
+                ok = ret.returncode == 0
+                if self.shared_vendor: 
+                    ok = self.convert_shared_deps(crate_path) and ok
+                if self.incremental: 
+                    self.write_fingerprint(MIR_FINGERPRINT, self.fingerprint("."))
+                self.mark(crate_path, "convert", ok)
                 os.chdir(safe_crate_dir)
 
-    def compile_benchmarks(self):
+    # In incremental mode, whether the converted copy of <crate_path> (the 
+    # current dir) is as its last successful conversion left it, in which 
+    # case that conversion, and the sites it recorded, still stand
+    def converted_unchanged(self, crate_path, mod=False):
+        if not self.incremental or not self.is_done(crate_path, "convert") or \
+                (mod and not os.path.exists("mir-filelist")) or \
+                self.read_fingerprint(MIR_FINGERPRINT) != self.fingerprint("."): 
+            return False
+        print("Unchanged since the last conversion of {}".format(crate_path))
+        return True
+
+    # Environment of the benchmark builds. With a shared cache rustc runs
+    # through sccache, so the unsafe and converted copies of a crate, and
+    # all crates on the same toolchain, reuse each other's compiled 
+    # dependencies and only what regexify rewrote is compiled again. 
+    # (The mir-filelist builds in convert_to_safe never use it: rustc 
+    # has to actually run to emit the filelist.)
+    def cargo_env(self):
+        env = os.environ.copy()
+        if self.shared_cache != None: 
+            env["RUSTC_WRAPPER"] = "sccache"
+            env["SCCACHE_DIR"] = self.shared_cache
+        return env
+
+    def compile_benchmarks(self, crate_paths=None):
+        crate_paths = self.crate_paths if crate_paths == None else crate_paths
+        # Builds run <self.jobs> at a time, each with an equal share of the
+        # cores, and no new build is started while memory use is near
+        # <self.mem_cap>
+        pending = []
         for DIR in EXP_DIRS: 
-            if DIR == UNSAFE_DIR:
-                print("Compiling unsafe baselines")
-            else: 
-                print("Compiling converted crates")
-            os.chdir(DIR)
-            for crate_path in self.crate_paths:
-                print("\t{}".format(crate_path))
-                os.chdir(crate_path)
-                with open(COMP_LOG, "w") as comp_log: 
-                    subprocess.run(["cargo", "clean"])
-                    try: 
-                        subprocess.run(["cargo", "bench", "--verbose", "--no-run"], 
-                            timeout=1200, stdout=comp_log, stderr=comp_log)
-                    except subprocess.TimeoutExpired as err:
-                        print(err)
-                        subprocess.run(["mkdir", "-p", "timeouts"])
-                        subprocess.run(["touch", "timeouts/compile-timedout"])
-                os.chdir(DIR)
+            for crate_path in crate_paths:
+                pending.append((DIR, crate_path))
+        cargo_jobs = max(1, (os.cpu_count() or 1) // self.jobs)
+        print("Compiling {} builds, {} at a time with -j {}".format(len(pending), self.jobs, cargo_jobs))
+        if self.shared_cache != None: 
+            # the sccache server picks up SCCACHE_DIR when it starts
+            subprocess.run(["sccache", "--start-server"], env=self.cargo_env(),
+                stdout=open(os.devnull, 'wb'), stderr=open(os.devnull, 'wb'))
+
+        # pid -> (DIR, crate_path, process, comp_log, start)
+        running = dict()
+        failed = set()
+        while pending or running: 
+            while pending and len(running) < self.jobs and (not running or self.memory_available()):
+                DIR, crate_path = pending.pop(0)
+                crate_dir = os.path.join(DIR, crate_path)
+                if self.incremental and self.read_fingerprint(os.path.join(crate_dir, "target", FINGERPRINT)) \
+                        == self.fingerprint(crate_dir): 
+                    print("\t{} ({}) unchanged".format(crate_path, "original" if DIR == UNSAFE_DIR else "converted"))
+                    continue
+                if DIR == UNSAFE_DIR and self.restore_baseline(crate_path): 
+                    print("\t{} (original) restored from {}".format(crate_path, self.bench_cache))
+                    continue
+                build = self.start_build(DIR, crate_path, cargo_jobs)
+                running[build[2].pid] = build
+            for DIR, crate_path, returncode in self.reap_builds(running): 
+                if returncode != 0: 
+                    failed.add(crate_path)
+        if self.shared_cache != None: 
+            subprocess.run(["sccache", "--show-stats"], env=self.cargo_env())
+        for crate_path in crate_paths: 
+            self.mark(crate_path, "compile", crate_path not in failed)
         os.chdir(ROOT_PATH)
 
-    def run_benchmarks(self):
+    def start_build(self, DIR, crate_path, cargo_jobs):
+        crate_dir = os.path.join(DIR, crate_path)
+        print("\t{} ({})".format(crate_path, "original" if DIR == UNSAFE_DIR else "converted"))
+        comp_log = open(os.path.join(crate_dir, COMP_LOG), "w")
+        subprocess.run(["cargo", "clean"], cwd=crate_dir, stdout=comp_log, stderr=comp_log)
+        # the diagnostics still go to the log, the JSON messages (from which
+        # the bench executables are taken) to target/
+        os.makedirs(os.path.join(crate_dir, "target"), exist_ok=True)
+        messages = open(os.path.join(crate_dir, "target", CARGO_MESSAGES), "w")
+        # own process group, so that a timeout also kills rustc
+        process = subprocess.Popen(["cargo", "bench", "--verbose", "--no-run", "-j", str(cargo_jobs), 
+            "--message-format=json-render-diagnostics"],
+            cwd=crate_dir, stdout=messages, stderr=comp_log, start_new_session=True,
+            env=self.cargo_env())
+        messages.close()
+        return (DIR, crate_path, process, comp_log, time.monotonic())
+
+    # Returns [(DIR, crate_path, returncode)] of the builds that finished
+    def reap_builds(self, running, timeout=1200):
+        finished = []
+        time.sleep(1)
+        for pid in list(running): 
+            DIR, crate_path, process, comp_log, start = running[pid]
+            crate_dir = os.path.join(DIR, crate_path)
+            done, status, rusage = os.wait4(pid, os.WNOHANG)
+            if done == 0: 
+                if time.monotonic() - start < timeout: 
+                    continue
+                timed_out = "Command '{}' timed out after {} seconds".format(" ".join(process.args), timeout)
+                print(timed_out)
+                comp_log.write(timed_out + "\n")
+                os.killpg(pid, signal.SIGKILL)
+                done, status, rusage = os.wait4(pid, 0)
+                subprocess.run(["mkdir", "-p", os.path.join(crate_dir, "timeouts")])
+                subprocess.run(["touch", os.path.join(crate_dir, "timeouts", "compile-timedout")])
+            process.returncode = os.waitstatus_to_exitcode(status)
+            del running[pid]
+            # ru_maxrss is in KB, and covers the largest process of the build
+            outcome = "exit {}, peak RSS {} MB".format(process.returncode, rusage.ru_maxrss // 1024)
+            comp_log.write("Build done: {}\n".format(outcome))
+            comp_log.close()
+            print("\t{} ({}) done: {}".format(crate_path, 
+                "original" if DIR == UNSAFE_DIR else "converted", outcome))
+            if process.returncode == 0: 
+                self.record_executables(crate_dir)
+            if self.incremental and process.returncode == 0: 
+                self.write_fingerprint(os.path.join(crate_dir, "target", FINGERPRINT), self.fingerprint(crate_dir))
+            if DIR == UNSAFE_DIR and process.returncode == 0: 
+                self.store_baseline(crate_path)
+            finished.append((DIR, crate_path, process.returncode))
+        return finished
+
+    # The executables cargo bench would run, in the order it runs them: 
+    # every artifact built with the test (harness) profile. Their paths 
+    # are kept relative to the crate, as target/ may be restored elsewhere
+    def record_executables(self, crate_dir):
+        exes = []
+        with open(os.path.join(crate_dir, "target", CARGO_MESSAGES), "r") as fd: 
+            for line in fd: 
+                try: 
+                    message = json.loads(line)
+                except ValueError:
+                    continue
+                if message.get("reason") != "compiler-artifact" or not message["profile"]["test"] \
+                        or not message.get("executable"): 
+                    continue
+                kind = message["target"]["kind"][0]
+                exes.append({
+                    "name": message["target"]["name"],
+                    "kind": kind,
+                    "executable": os.path.relpath(message["executable"], crate_dir),
+                })
+        order = ["lib", "bin"]
+        exes.sort(key=lambda exe: (order.index(exe["kind"]) if exe["kind"] in order else len(order), 
+            exe["name"]))
+        with open(os.path.join(crate_dir, "target", BENCH_EXES), "w") as fd: 
+            json.dump(exes, fd, indent=4)
+
+    # Run the benchmarks of a crate like cargo bench does, but executing 
+    # the binaries recorded by compile_benchmarks directly, so that cargo 
+    # neither adds its own overhead to a run nor rebuilds anything in the 
+    # middle of the measurements. Falls back to cargo bench if the crate 
+    # was built without recording them.
+    def bench(self, crate_dir, out, results, stderr, timeout=1800, pin=[]):
+        exes = self.bench_executables(crate_dir)
+        if exes == None: 
+            return self.stream(pin + ["cargo", "bench", "--verbose"], out, results, stderr, 
+                timeout, cwd=crate_dir)
+
+        env = self.bench_env(crate_dir)
+        deadline = time.monotonic() + timeout
+        for exe in exes: 
+            executable = os.path.join(crate_dir, exe["executable"])
+            stderr.write("     Running `{} --bench`\n".format(executable))
+            stderr.flush()
+            ret = self.stream(pin + [executable, "--bench"], out, results, stderr, 
+                max(1, deadline - time.monotonic()), cwd=crate_dir, env=env)
+            # cargo bench stops at the first failing executable
+            if ret != 0: 
+                return ret
+        return 0
+
+    # Run <cmd>, parsing its output as it is printed: the raw output goes 
+    # to <out>, and every benchmark to the <results> file as soon as it is 
+    # done, so that a run that times out keeps what it measured. Returns 
+    # the exit code, or raises TimeoutExpired like subprocess.run.
+    def stream(self, cmd, out, results, stderr, timeout, **kwargs):
+        # in a session of its own, to kill whatever it started along with it
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr, text=True, 
+            errors="replace", start_new_session=True, **kwargs)
+        expired = threading.Event()
+        def kill(): 
+            try: 
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        def watchdog_expired(): 
+            expired.set()
+            kill()
+        watchdog = threading.Timer(timeout, watchdog_expired)
+        watchdog.start()
+        parser = StreamParser()
+        try: 
+            for line in proc.stdout: 
+                out.write(line)
+                result = parser.feed(line)
+                if result != None: 
+                    write_result(results, *result)
+        except BaseException: 
+            kill()
+            raise
+        finally: 
+            watchdog.cancel()
+            proc.stdout.close()
+            ret = proc.wait()
+        if expired.is_set(): 
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        return ret
+
+    def bench_executables(self, crate_dir):
+        try: 
+            with open(os.path.join(crate_dir, "target", BENCH_EXES), "r") as fd: 
+                return json.load(fd)
+        except (OSError, ValueError):
+            return None
+
+    def bench_env(self, crate_dir):
+        env = os.environ.copy()
+        # where criterion keeps its data, instead of asking cargo metadata
+        env["CARGO_TARGET_DIR"] = os.path.join(crate_dir, "target")
+        env["CARGO_MANIFEST_DIR"] = crate_dir
+        deps = os.path.join(crate_dir, "target", "release", "deps")
+        env["LD_LIBRARY_PATH"] = os.pathsep.join(filter(None, [deps, env.get("LD_LIBRARY_PATH")]))
+        return env
+
+    # [(benchmark id, executable)] of a crate, in the order its suite runs 
+    # them (None without recorded executables)
+    def list_benchmarks(self, crate_dir):
+        exes = self.bench_executables(crate_dir)
+        if exes == None: 
+            return None
+        benches = []
+        for exe in exes: 
+            ret = subprocess.run([os.path.join(crate_dir, exe["executable"]), "--bench", "--list"], 
+                cwd=crate_dir, env=self.bench_env(crate_dir), capture_output=True, text=True, timeout=300)
+            for line in ret.stdout.splitlines(): 
+                if line.endswith(": bench"): 
+                    benches.append((line[:-len(": bench")], exe["executable"]))
+        return benches
+
+    # Inputs of a build: the hashes of the crate's sources (including 
+    # vendor/, Cargo.lock and .cargo/config.toml), and the toolchain. In 
+    # incremental mode a build whose recorded fingerprint matches is not 
+    # redone, and any difference means a clean rebuild.
+    def fingerprint(self, crate_dir):
+        sources = dict()
+        for root, dirs, files in os.walk(crate_dir): 
+            rel_root = os.path.relpath(root, crate_dir)
+            if rel_root == ".": 
+                dirs[:] = [d for d in dirs if d not in NOT_INPUTS and not d.startswith(RESULTS)]
+                files = [f for f in files if f not in NOT_INPUTS]
+            dirs.sort()
+            # entries of the shared vendor store, which never change
+            for dname in dirs: 
+                if os.path.islink(os.path.join(root, dname)): 
+                    sources[os.path.normpath(os.path.join(rel_root, dname))] = \
+                        "-> " + os.readlink(os.path.join(root, dname))
+            for fname in files: 
+                path = os.path.join(root, fname)
+                if os.path.islink(path) or not os.path.isfile(path): 
+                    continue
+                with open(path, "rb") as fd: 
+                    sources[os.path.normpath(os.path.join(rel_root, fname))] = hashlib.sha256(fd.read()).hexdigest()
+        # the rustup override of the crate decides which rustc cargo runs
+        rustc = subprocess.run(["rustc", "--version", "--verbose"], cwd=crate_dir,
+            capture_output=True, text=True)
+        return {
+            "toolchain": [self.rust_version, rustc.stdout],
+            "sources": sources,
+        }
+
+    def read_fingerprint(self, fname):
+        try: 
+            with open(fname, "r") as fd: 
+                return json.load(fd)
+        except (OSError, ValueError):
+            return None
+
+    def write_fingerprint(self, fname, fingerprint):
+        with open(fname + ".tmp", "w") as fd: 
+            json.dump(fingerprint, fd, sort_keys=True)
+        os.replace(fname + ".tmp", fname)
+
+    # The unsafe baselines do not change between campaigns that use the same
+    # toolchain and flags, so their builds are kept in <self.bench_cache>,
+    # content-addressed by the crate version, its Cargo.lock, the toolchain 
+    # (and the exact rustc it resolves to, which for "mod" is rebuilt in 
+    # place), RUSTFLAGS and the Cargo profile settings. An entry holds what 
+    # the runs need, the recorded bench executables and their list, at 
+    # their paths under target/, together with the Cargo.lock they were 
+    # built from.
+    def baseline_key(self, crate_path):
+        crate_dir = os.path.join(UNSAFE_DIR, crate_path)
+        profile = sorted((var, value) for var, value in os.environ.items() 
+            if var.startswith(("CARGO_PROFILE_BENCH_", "CARGO_PROFILE_RELEASE_")))
+        # the rustup override of the crate decides which rustc cargo runs
+        rustc = subprocess.run(["rustc", "--version", "--verbose"], cwd=crate_dir,
+            capture_output=True, text=True)
+        try: 
+            with open(os.path.join(crate_dir, "Cargo.lock"), "rb") as fd: 
+                lock = hashlib.sha256(fd.read()).hexdigest()
+        except OSError: 
+            lock = None
+        key = {
+            "crate": crate_path,
+            "lock": lock,
+            "toolchain": self.rust_version,
+            "rustc": rustc.stdout,
+            "rustflags": os.environ.get("RUSTFLAGS", ""),
+            "profile": ["bench"] + profile,
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest(), key
+
+    def restore_baseline(self, crate_path):
+        if self.bench_cache == None: 
+            return False
+        crate_dir = os.path.join(UNSAFE_DIR, crate_path)
+        # resolve the dependencies first (as the build would), so that the 
+        # key covers them
+        if not os.path.exists(os.path.join(crate_dir, "Cargo.lock")): 
+            subprocess.run(["cargo", "generate-lockfile"], cwd=crate_dir,
+                stdout=open(os.devnull, 'wb'), stderr=open(os.devnull, 'wb'))
+        digest, key = self.baseline_key(crate_path)
+        # stored under the same key after the build, even if it touches Cargo.lock
+        self.baseline_keys[crate_path] = (digest, key)
+        entry = os.path.join(self.bench_cache, digest)
+        if not os.path.isdir(entry): 
+            return False
+        exes = self.bench_executables(entry)
+        if exes == None: 
+            return False
+        shutil.rmtree(os.path.join(crate_dir, "target"), ignore_errors=True)
+        for fname in [os.path.join("target", BENCH_EXES)] + [exe["executable"] for exe in exes]: 
+            os.makedirs(os.path.dirname(os.path.join(crate_dir, fname)), exist_ok=True)
+            shutil.copy2(os.path.join(entry, fname), os.path.join(crate_dir, fname))
+        if os.path.exists(os.path.join(entry, "Cargo.lock")): 
+            shutil.copy2(os.path.join(entry, "Cargo.lock"), os.path.join(crate_dir, "Cargo.lock"))
+        return True
+
+    def store_baseline(self, crate_path):
+        if self.bench_cache == None: 
+            return
+        digest, key = self.baseline_keys.pop(crate_path, None) or self.baseline_key(crate_path)
+        entry = os.path.join(self.bench_cache, digest)
+        if os.path.isdir(entry): 
+            return
+        crate_dir = os.path.join(UNSAFE_DIR, crate_path)
+        exes = self.bench_executables(crate_dir)
+        if exes == None: 
+            return
+        os.makedirs(self.bench_cache, exist_ok=True)
+        # fill a temp dir first and rename it, so that an entry is complete
+        tmp = tempfile.mkdtemp(dir=self.bench_cache, prefix=".tmp-")
+        for fname in [os.path.join("target", BENCH_EXES)] + [exe["executable"] for exe in exes]: 
+            os.makedirs(os.path.dirname(os.path.join(tmp, fname)), exist_ok=True)
+            shutil.copy2(os.path.join(crate_dir, fname), os.path.join(tmp, fname))
+        if os.path.exists(os.path.join(crate_dir, "Cargo.lock")): 
+            shutil.copy2(os.path.join(crate_dir, "Cargo.lock"), os.path.join(tmp, "Cargo.lock"))
+        with open(os.path.join(tmp, "key.json"), "w") as fd: 
+            json.dump(key, fd, indent=4)
+        try: 
+            os.rename(tmp, entry)
+        except OSError: 
+            # stored by someone else in the meantime
+            shutil.rmtree(tmp)
+
+    # True if another build may be started under <self.mem_cap> (in MB)
+    def memory_available(self):
+        if self.mem_cap == None: 
+            return True
+        meminfo = dict()
+        try: 
+            with open("/proc/meminfo", "r") as fd: 
+                for line in fd: 
+                    field, value = line.split(":")
+                    meminfo[field] = int(value.split()[0])
+        except (OSError, ValueError):
+            return True
+        used = (meminfo["MemTotal"] - meminfo["MemAvailable"]) // 1024
+        return used < 0.9 * self.mem_cap
+
+    def run_benchmarks(self, crate_paths=None):
+        crate_paths = self.crate_paths if crate_paths == None else crate_paths
         # Create results directory for raw output
         for DIR in EXP_DIRS: 
-            for crate in self.crate_paths: 
+            for crate in crate_paths: 
                 os.chdir(os.path.join(DIR, crate))
                 subprocess.run(["mkdir", "-p", self.raw_results])
                 os.chdir(os.path.join(DIR, crate, self.raw_results))
@@ -177,98 +969,455 @@ class CIO:
         # Create results directory for aggregated output
         subprocess.run(["mkdir", "-p", self.agg_results])
         os.chdir(self.agg_results)
-        for crate in self.crate_paths: 
+        for crate in crate_paths: 
             os.chdir(self.agg_results)
             subprocess.run(["mkdir", "-p", crate])
             os.chdir(crate)
-            for run in range(self.num_runs):
+            for run in range(self.num_runs + (NOISY_RERUNS if self.interleave else 0)):
                 subprocess.run(["mkdir", "-p", str(run)])
             os.chdir(self.agg_results)
-                
+
+        # the runs of an earlier run stage do not count unless resuming
+        if not self.resume: 
+            for crate in crate_paths: 
+                self.manifest.get(crate, dict()).pop("run", None)
+
+        # (run, crate) in the order they would be benchmarked one after the other
+        units = []
         for run in range(self.num_runs): 
-            print("Run #{}".format(str(run)))
-            # In even runs benchmark safe crates first, 
-            # in odd runs benchmark unsafe crates first
-            #   <run> goes from 0 to len(self.num_runs) - 1
-            LOCAL_EXP_DIRS = [SAFE_DIR, UNSAFE_DIR] if run % 2 == 0 else EXP_DIRS
+            # When resuming, runs that completed are not redone
+            run_crates = [crate for crate in crate_paths 
+                if not (self.resume and self.is_done(crate, "run", run))]
             # Randomize crate order for every new run
-            random.shuffle(self.crate_paths)
-            count = 0
-            for crate in self.crate_paths:
-                count += 1
-                print("\tBenchmarking {} ({}/{} crates)".format(crate, count, len(self.crate_paths)))
-                for DIR in LOCAL_EXP_DIRS:
-                    if DIR == UNSAFE_DIR:
-                        print("\t\toriginal")
-                    else: 
-                        print("\t\tconverted")
-                    os.chdir(os.path.join(DIR, crate))
-                    run_out = os.path.join(self.raw_results, str(run), RUN_OUT)
-                    run_err = os.path.join(self.raw_results, str(run), RUN_ERR)
-                    with open(run_out, "w") as ro, open(run_err, "w") as re: 
-                        try: 
-                            subprocess.run(["cargo", "bench", "--verbose"], 
-                                timeout=1800, stdout=ro, stderr=re)
-                        except subprocess.TimeoutExpired as err:
-                            print(err)
-                            subprocess.run(["mkdir", "-p", "timeouts"])
-                            subprocess.run(["touch", "timeouts/run-{}-timedout".format(str(run))])
+            random.shuffle(run_crates)
+            units += [(run, crate) for crate in run_crates]
+        self.schedule_runs(units, self.run_jobs, self.raw_results)
+        if self.interleave: 
+            self.rerun_noisy(crate_paths, self.raw_results)
         os.chdir(ROOT_PATH)
 
-    def aggregate_results(self):
-        print("Aggregating results")
+    # Benchmark the (run, crate) units <jobs> at a time, each on its own 
+    # CPU set, taking them in order but never two of the same crate at once
+    # (they would share its criterion data), with <run_unit> (by default 
+    # self.run_unit). The runs are recorded in the manifest if <record>. 
+    def schedule_runs(self, units, jobs, results, record=True, run_unit=None):
+        run_unit = self.run_unit if run_unit == None else run_unit
+        slots = [(None, None)] if jobs == 1 else self.cpu_slots(jobs)
+        if jobs != 1: 
+            print("Benchmarking {} crates at a time, on CPUs {}".format(len(slots), 
+                " / ".join(",".join(str(cpu) for cpu in cpus) for cpus, node in slots)))
+        pending = list(units)
+        busy = set()
+        started = set()
+        cond = threading.Condition()
+
+        def worker(slot): 
+            while True: 
+                with cond: 
+                    while True: 
+                        unit = next((unit for unit in pending if unit[1] not in busy), None)
+                        if unit != None or not pending: 
+                            break
+                        cond.wait()
+                    if unit == None: 
+                        return
+                    run, crate = unit
+                    pending.remove(unit)
+                    busy.add(crate)
+                    if run not in started: 
+                        started.add(run)
+                        print("Run #{}".format(str(run)))
+                    print("\tBenchmarking {} ({} left)".format(crate, len(pending)))
+                ok = False
+                try: 
+                    ok = run_unit(run, crate, slot, results)
+                except Exception as e: 
+                    # the run failed, the other units still go on
+                    print("\tBenchmarking {} failed: {!r}".format(crate, e))
+                finally: 
+                    runs = None
+                    try: 
+                        if record: 
+                            with cond: 
+                                self.mark(crate, "run", ok, run)
+                                runs = self.completed_runs(crate)
+                            # reads the results of every run, so without 
+                            # holding up the other workers (the crate stays 
+                            # busy, no run of it starts in the meantime)
+                            if self.ci_width == None or not self.converged(crate, results, runs): 
+                                runs = None
+                    finally: 
+                        with cond: 
+                            # the waiting workers only go on once the lock 
+                            # is released, by then pending is up to date, 
+                            # and it is released even if recording fails
+                            busy.discard(crate)
+                            cond.notify_all()
+                            if runs != None: 
+                                # no more runs of this crate
+                                pending[:] = [unit for unit in pending if unit[1] != crate]
+                                self.manifest[crate]["run"]["converged"] = runs
+                                self.save_manifest()
+
+        workers = [threading.Thread(target=worker, args=(slot,)) for slot in slots]
+        for thread in workers: 
+            thread.start()
+        for thread in workers: 
+            thread.join()
+
+    # Whether the completed <runs> of <crate> (at least <self.min_runs>) pin 
+    # down the safe/unsafe ratio of every benchmark to within <self.ci_width>
+    def converged(self, crate, results, runs):
+        if len(runs) < self.min_runs: 
+            return False
+        # bench -> [safe/unsafe ratio of every run]
+        ratios = dict()
+        for run in runs: 
+            times = []
+            for DIR in EXP_DIRS: 
+                times.append(read_results(os.path.join(DIR, crate, results, str(run), RUN_RESULTS)))
+            unsafe_times, safe_times = times
+            for name, (lo, mid, hi) in unsafe_times.items(): 
+                if name in safe_times and mid > 0: 
+                    ratios.setdefault(name, []).append(safe_times[name][1] / mid)
+        if not ratios: 
+            return False
+        widths = [2 * ci95(samples)[1] for samples in ratios.values()]
+        print("\t{}: widest CI of the ratios after {} runs is {:.4f}".format(crate, len(runs), max(widths)))
+        return max(widths) < self.ci_width
+
+    def run_unit(self, run, crate, slot, results):
+        # In even runs benchmark safe crates first, 
+        # in odd runs benchmark unsafe crates first
+        #   <run> goes from 0 to len(self.num_runs) - 1
+        LOCAL_EXP_DIRS = [SAFE_DIR, UNSAFE_DIR] if run % 2 == 0 else EXP_DIRS
+        if self.interleave: 
+            ok = self.run_interleaved(run, crate, slot, results)
+            if ok != None: 
+                return ok
+        ok = True
+        for DIR in LOCAL_EXP_DIRS:
+            crate_dir = os.path.join(DIR, crate)
+            run_dir = os.path.join(crate_dir, results, str(run))
+            os.makedirs(run_dir, exist_ok=True)
+            shutil.rmtree(os.path.join(run_dir, CRITERION_SNAPSHOT), ignore_errors=True)
+            since = time.time()
+            with gzip.open(os.path.join(run_dir, RUN_LOG), "wt") as ro, \
+                    open(os.path.join(run_dir, RUN_RESULTS), "w") as rr, \
+                    open(os.path.join(run_dir, RUN_ERR), "w") as re: 
+                try: 
+                    ok = self.bench(crate_dir, ro, rr, re, pin=self.pin(slot)) == 0 and ok
+                except subprocess.TimeoutExpired as err:
+                    print(err)
+                    ok = False
+                    subprocess.run(["mkdir", "-p", os.path.join(crate_dir, "timeouts")])
+                    subprocess.run(["touch", os.path.join(crate_dir, "timeouts", "run-{}-timedout".format(str(run)))])
+            self.snapshot_criterion(crate_dir, run_dir, since)
+        return ok
+
+    # Copy the results criterion wrote (<target>/criterion/<id>/new/*.json) 
+    # since <since> to <run_dir>/criterion, before the next run of the crate 
+    # replaces them
+    def snapshot_criterion(self, crate_dir, run_dir, since):
+        criterion_dir = os.path.join(crate_dir, "target", "criterion")
+        for dirpath, dirnames, filenames in os.walk(criterion_dir):
+            if os.path.basename(dirpath) != "new": 
+                continue
+            fresh = [fname for fname in filenames if fname.endswith(".json") and 
+                os.path.getmtime(os.path.join(dirpath, fname)) >= since]
+            if not fresh: 
+                continue
+            snapshot_dir = os.path.join(run_dir, CRITERION_SNAPSHOT, os.path.relpath(dirpath, criterion_dir))
+            os.makedirs(snapshot_dir, exist_ok=True)
+            for fname in fresh: 
+                shutil.copy2(os.path.join(dirpath, fname), snapshot_dir)
+
+    # Interleaved mode: rather than the whole suite of one variant and then 
+    # the whole suite of the other, every benchmark runs on its own, for one 
+    # variant right after the other, so that drift over the length of a 
+    # suite affects both alike. The output of every benchmark is kept in 
+    # <run dir>/interleaved/<index>.*, and run.* are their concatenation in 
+    # suite order, as for a whole-suite run. Returns None (to run whole 
+    # suites instead) if the benchmarks cannot be listed. 
+    def run_interleaved(self, run, crate, slot, results, benches=None):
+        # [(id, {DIR: executable})], benchmarks of both variants in suite order
+        if benches == None: 
+            listings = dict()
+            for DIR in EXP_DIRS: 
+                listings[DIR] = self.list_benchmarks(os.path.join(DIR, crate))
+                if listings[DIR] == None: 
+                    return None
+            safe_exes = dict(listings[SAFE_DIR])
+            benches = [(name, {UNSAFE_DIR: exe, SAFE_DIR: safe_exes[name]}) 
+                for name, exe in listings[UNSAFE_DIR] if name in safe_exes]
+        for DIR in EXP_DIRS: 
+            bench_dir = os.path.join(DIR, crate, results, str(run), INTERLEAVED)
+            shutil.rmtree(bench_dir, ignore_errors=True)
+            shutil.rmtree(os.path.join(DIR, crate, results, str(run), CRITERION_SNAPSHOT), ignore_errors=True)
+            os.makedirs(bench_dir)
+            with open(os.path.join(bench_dir, "benches.json"), "w") as fd: 
+                json.dump([(name, exes[DIR]) for name, exes in benches], fd, indent=4)
+
+        ok = True
+        for idx, (name, exes) in enumerate(benches): 
+            ok = self.run_benchmark(run, crate, slot, results, idx, name, exes) and ok
+        for DIR in EXP_DIRS: 
+            self.join_benchmarks(os.path.join(DIR, crate, results, str(run)), len(benches))
+        return ok
+
+    def run_benchmark(self, run, crate, slot, results, idx, name, exes):
+        ok = True
+        for DIR in ([SAFE_DIR, UNSAFE_DIR] if run % 2 == 0 else EXP_DIRS): 
+            crate_dir = os.path.join(DIR, crate)
+            run_dir = os.path.join(crate_dir, results, str(run))
+            bench_out = os.path.join(run_dir, INTERLEAVED, str(idx))
+            since = time.time()
+            with gzip.open(bench_out + ".out.gz", "wt") as ro, open(bench_out + ".results", "w") as rr, \
+                    open(bench_out + ".err", "w") as re: 
+                try: 
+                    ret = self.stream(self.pin(slot) + [os.path.join(crate_dir, exes[DIR]), "--bench", 
+                        exact_filter([name])], ro, rr, re, 1800, cwd=crate_dir, env=self.bench_env(crate_dir))
+                    ok = ret == 0 and ok
+                except subprocess.TimeoutExpired as err:
+                    print(err)
+                    ok = False
+                    subprocess.run(["mkdir", "-p", os.path.join(crate_dir, "timeouts")])
+                    subprocess.run(["touch", os.path.join(crate_dir, "timeouts", "run-{}-timedout".format(str(run)))])
+            self.snapshot_criterion(crate_dir, run_dir, since)
+        return ok
+
+    def join_benchmarks(self, run_dir, count):
+        # gzip files can be concatenated as they are
+        for ext, joined in [(".out.gz", RUN_LOG), (".results", RUN_RESULTS), (".err", RUN_ERR)]: 
+            with open(os.path.join(run_dir, joined), "wb") as fd: 
+                for idx in range(count): 
+                    with open(os.path.join(run_dir, INTERLEAVED, str(idx) + ext), "rb") as bench_fd: 
+                        shutil.copyfileobj(bench_fd, fd)
+
+    # Rerun the benchmarks of interleaved crates whose safe/unsafe ratio 
+    # varies across runs by more than <self.rerun_cv> (coefficient of 
+    # variation), up to NOISY_RERUNS times. Every rerun is an extra run, 
+    # <self.num_runs> + n, of the noisy benchmarks only, scheduled (and 
+    # pinned) like the other runs, and aggregated with them: it adds a 
+    # sample, the runs that were noisy are kept as they are.
+    def rerun_noisy(self, crate_paths, results):
+        for rerun in range(NOISY_RERUNS): 
+            run = self.num_runs + rerun
+            noisy = dict()
+            for crate in crate_paths: 
+                # when resuming, the reruns that completed are not redone
+                if self.is_done(crate, "run", run): 
+                    continue
+                benches = self.noisy_benchmarks(crate, results)
+                if benches: 
+                    print("\t{}: rerunning {} noisy benchmarks".format(crate, len(benches)))
+                    noisy[crate] = benches
+            if not noisy: 
+                return
+            self.schedule_runs([(run, crate) for crate in sorted(noisy)], self.run_jobs, results, 
+                run_unit=lambda run, crate, slot, results: 
+                    self.run_interleaved(run, crate, slot, results, noisy[crate]))
+
+    # [(id, {DIR: executable})] of the benchmarks of an interleaved <crate> 
+    # whose safe/unsafe ratio varies too much across its completed runs
+    def noisy_benchmarks(self, crate, results):
+        # id -> [safe/unsafe ratio of every run]
+        ratios = dict()
+        exes = dict()
+        for run in self.completed_runs(crate): 
+            listings = dict()
+            for DIR in EXP_DIRS: 
+                try: 
+                    with open(os.path.join(DIR, crate, results, str(run), INTERLEAVED, "benches.json"), "r") as fd: 
+                        listings[DIR] = json.load(fd)
+                except (OSError, ValueError):
+                    # not an interleaved run
+                    return []
+            for idx, (name, exe) in enumerate(listings[UNSAFE_DIR]): 
+                times = []
+                for DIR in EXP_DIRS: 
+                    # one benchmark per file
+                    times.append(next(iter(read_results(os.path.join(DIR, crate, results, 
+                        str(run), INTERLEAVED, str(idx) + ".results")).values()), None))
+                if None in times or times[0][1] <= 0: 
+                    continue
+                ratios.setdefault(name, []).append(times[1][1] / times[0][1])
+                exes[name] = {DIR: listings[DIR][idx][1] for DIR in EXP_DIRS}
+
+        noisy = []
+        for name, values in sorted(ratios.items()): 
+            if len(values) < 3: 
+                continue
+            avg, stdev = stats(values)
+            if stdev / avg > self.rerun_cv: 
+                noisy.append((name, exes[name]))
+        return noisy
+
+    # Split the CPUs we may use into <jobs> sets, [(cpus, node)], with node 
+    # the NUMA node of the set if it is on a single one. With at least as 
+    # many nodes as sets, every set is a whole node, so that concurrent 
+    # benchmarks do not share caches or memory bandwidth either. 
+    def cpu_slots(self, jobs):
+        node_of = dict()
+        try: 
+            for entry in os.listdir(NODE_DIR): 
+                if entry.startswith("node") and entry[4:].isdigit(): 
+                    with open(os.path.join(NODE_DIR, entry, "cpulist"), "r") as fd: 
+                        for cpu in parse_cpulist(fd.read()): 
+                            node_of[cpu] = int(entry[4:])
+        except OSError:
+            pass
+        cpus = sorted(os.sched_getaffinity(0), key=lambda cpu: (node_of.get(cpu, -1), cpu))
+        if jobs > len(cpus): 
+            print("Only {} CPUs to benchmark on, running {} at a time".format(len(cpus), len(cpus)))
+            jobs = len(cpus)
+
+        nodes = sorted(set(node_of.get(cpu, -1) for cpu in cpus))
+        if jobs <= len(nodes): 
+            sets = [[cpu for cpu in cpus if node_of.get(cpu, -1) == node] for node in nodes[:jobs]]
+        else: 
+            size = len(cpus) // jobs
+            sets = [cpus[i * size:(i + 1) * size] for i in range(jobs)]
+        slots = []
+        for cpu_set in sets: 
+            set_nodes = set(node_of.get(cpu, -1) for cpu in cpu_set)
+            node = set_nodes.pop() if len(set_nodes) == 1 else None
+            slots.append((cpu_set, None if node == -1 else node))
+        return slots
 
-        # Parse per-run data
-        for crate_path in self.crate_paths: 
-            for run in range(self.num_runs):
-                unsafe_res = os.path.join(UNSAFE_DIR, crate_path, self.raw_results, str(run), RUN_OUT)
-                safe_res = os.path.join(SAFE_DIR, crate_path, self.raw_results, str(run), RUN_OUT)
-                parsed_file = os.path.join(self.agg_results, crate_path, str(run), RUN_PARSED)
-                dump_benchmark(parsed_file, unsafe_res, safe_res, 1)
+    # Command prefix that pins a benchmark to its slot (and its memory to 
+    # the slot's NUMA node)
+    def pin(self, slot):
+        cpus, node = slot
+        if cpus == None: 
+            return []
+        cpulist = ",".join(str(cpu) for cpu in cpus)
+        if node != None and shutil.which("numactl"): 
+            return ["numactl", "--physcpubind={}".format(cpulist), "--membind={}".format(node)]
+        if shutil.which("taskset"): 
+            return ["taskset", "-c", cpulist]
+        print("Neither numactl nor taskset found, benchmarks are not pinned")
+        return []
+
+    # Benchmark <crate_paths> <self.num_runs> times one after the other, then 
+    # <self.run_jobs> at a time, and check that both give the same medians 
+    # within the spread of the runs, before trusting concurrent runs
+    def calibrate(self, crate_paths=None):
+        crate_paths = self.crate_paths if crate_paths == None else crate_paths
+        # (crate, variant, bench) -> {mode: [median estimate of every run]}
+        samples = dict()
+        for mode, jobs in [("serial", 1), ("concurrent", self.run_jobs)]: 
+            print("Calibrating, {} runs {}".format(self.num_runs, mode))
+            results = os.path.join("{}-calibrate".format(self.raw_results), mode)
+            units = []
+            for run in range(self.num_runs): 
+                run_crates = list(crate_paths)
+                random.shuffle(run_crates)
+                units += [(run, crate) for crate in run_crates]
+            self.schedule_runs(units, jobs, results, record=False)
+
+            for crate in crate_paths: 
+                for DIR in EXP_DIRS: 
+                    variant = "original" if DIR == UNSAFE_DIR else "converted"
+                    for run in range(self.num_runs): 
+                        for name, (lo, mid, hi) in read_results(os.path.join(DIR, crate, results, 
+                                str(run), RUN_RESULTS)).items(): 
+                            samples.setdefault((crate, variant, name), dict()).setdefault(mode, []).append(mid)
+
+        total = 0
+        differ = 0
+        for (crate, variant, name), modes in sorted(samples.items()): 
+            serial = modes.get("serial")
+            concurrent = modes.get("concurrent")
+            if not serial or not concurrent: 
+                continue
+            total += 1
+            noise = max(max(serial) - min(serial), max(concurrent) - min(concurrent))
+            if abs(median(concurrent) - median(serial)) > noise: 
+                differ += 1
+                print("\t{} ({}) {}: {:.4g} ns serial, {:.4g} ns concurrent ({:+.1%})".format(crate, variant, 
+                    name, median(serial), median(concurrent), median(concurrent) / median(serial) - 1))
+        print("{} of {} benchmarks have the same median within noise".format(total - differ, total))
+        os.chdir(ROOT_PATH)
+        return differ == 0
+
+    def runs_have(self, crate_path, runs, fname):
+        return all(os.path.exists(os.path.join(DIR, crate_path, self.raw_results, str(run), fname)) 
+            for DIR in EXP_DIRS for run in runs)
+
+    def aggregate_results(self, crate_paths=None):
+        crate_paths = self.crate_paths if crate_paths == None else crate_paths
+        print("Aggregating results")
         os.chdir(self.agg_results)
 
-        # Aggregate across runs
-        for crate_path in self.crate_paths: 
+        for crate_path in crate_paths: 
             crunchedfile = os.path.join(self.agg_results, crate_path, CRUNCHED)
             path_wrangle(crunchedfile, HEADERS)
+            runs = self.completed_runs(crate_path)
+            # criterion's own estimates if every run kept them, else the 
+            # results streamed during the runs, else the output of runs of 
+            # an earlier version
+            source = next((fname for fname in [CRITERION_SNAPSHOT, RUN_RESULTS] 
+                if self.runs_have(crate_path, runs, fname)), RUN_OUT)
 
-            # Use one file to get the number of unique benchmarks
-            samplefile = os.path.join(self.agg_results, crate_path, "0", RUN_PARSED)
-            with open(samplefile, "r") as fd: 
-                rows = len(fd.readlines()) - 1
+            # Parse per-run data (of the runs that completed, which with 
+            # adaptive runs may be fewer than <self.num_runs>) into a matrix 
+            # of the <time> columns, by benchmark, with NaN where a run did 
+            # not measure a benchmark
+            names = dict()
             cols = 2
-            matrix = numpy.zeros((rows, cols, self.num_runs))
-
-            # Populate matrix with per-run data for each benchmark
-            bench_names = []
-            for run in range(self.num_runs):
-                infile = os.path.join(self.agg_results, crate_path, str(run), RUN_PARSED)
-                with open(infile, "r") as infd: 
-                    for row, line in enumerate(infd): 
-                        # Skip header
-                        if row == 0: 
-                            continue
-                        columns = line.split()
-                        for col in range(len(columns)):
-                            # Get benchmark names from single file
-                            if run == 0 and col == 0: 
-                                bench_names.append(columns[col])
-                            # Collect <time> columns
-                            if col % 2 == 1: 
-                                mcol_idx = int((col - 1) / 2)
-                                matrix[row-1][mcol_idx][run] = columns[col]
-
-            # Crunch matrix
-            with open(crunchedfile, 'a') as crunchfd: 
-                for row in range(rows):
-                    cur = []
-                    bench_name = bench_names[row]
-                    cur.append(bench_name)
+            matrix = None
+            for idx, run in enumerate(runs):
+                parsed = self.parse_run(crate_path, run, source)
+                if matrix is None:
+                    # room for as many benchmarks as the first run has
+                    matrix = numpy.full((max(len(parsed), 1), cols, len(runs)), numpy.nan)
+                for columns in parsed:
+                    row = names.setdefault(columns[0], len(names))
+                    if row == len(matrix):
+                        # later runs have more, double it
+                        matrix = numpy.concatenate([matrix, numpy.full(matrix.shape, numpy.nan)])
                     for col in range(cols):
-                        med, stdev = stats2(matrix[row][col])
+                        matrix[row][col][idx] = columns[2 * col + 1]
+
+            # Crunch matrix, over the runs that measured each benchmark
+            missing = []
+            with open(crunchedfile, 'a') as crunchfd:
+                for bench_name, row in names.items():
+                    cur = [bench_name]
+                    measured = numpy.isfinite(matrix[row][0])
+                    # reruns only have the noisy benchmarks
+                    missed = [run for idx, run in enumerate(runs) if not measured[idx] and run < self.num_runs]
+                    if missed:
+                        missing.append((bench_name, missed))
+                    for col in range(cols):
+                        med, stdev = stats2(matrix[row][col][measured])
                         cur.append(str(med))
                         cur.append(str(stdev))
                     writerow(crunchfd, cur)
+            if missing:
+                print("\t{}: {} of {} benchmarks missing from some runs".format(crate_path, len(missing), len(names)))
+                for bench_name, missed in missing[:10]:
+                    print("\t\t{} (runs {})".format(bench_name, ", ".join(str(run) for run in missed)))
+                if len(missing) > 10:
+                    print("\t\t...")
+            self.mark(crate_path, "aggregate", True)
+
+    # Write the run.parsed file of a run of <crate_path> from its <source> 
+    # files, and return its rows
+    def parse_run(self, crate_path, run, source):
+        unsafe_run = os.path.join(UNSAFE_DIR, crate_path, self.raw_results, str(run))
+        safe_run = os.path.join(SAFE_DIR, crate_path, self.raw_results, str(run))
+        parsed_file = os.path.join(self.agg_results, crate_path, str(run), RUN_PARSED)
+        if source == CRITERION_SNAPSHOT:
+            return dump_estimates(parsed_file, os.path.join(unsafe_run, CRITERION_SNAPSHOT),
+                os.path.join(safe_run, CRITERION_SNAPSHOT),
+                os.path.join(self.agg_results, crate_path, str(run), RUN_SAMPLES))
+        if source == RUN_RESULTS:
+            return dump_results(parsed_file, os.path.join(unsafe_run, RUN_RESULTS),
+                os.path.join(safe_run, RUN_RESULTS))
+        return dump_benchmark(parsed_file, os.path.join(unsafe_run, RUN_OUT),
+            os.path.join(safe_run, RUN_OUT), 1)
 
 def arg_parse():
     parser = argparse.ArgumentParser()
@@ -290,45 +1439,101 @@ def arg_parse():
         type=int,
         help="specify the number of times to run each benchmark "\
             "(if not specified, default is 10)")
+    parser.add_argument("--jobs", "-j",
+        metavar="N",
+        type=int,
+        help="number of crates to compile at the same time, each with an "\
+            "equal share of the cores (if not specified, default is 1)")
+    parser.add_argument("--mem-cap", "-m",
+        metavar="MB",
+        type=int,
+        help="do not start another compilation while the memory in use is "\
+            "within 10%% of this many MB")
+    parser.add_argument("--shared-cache", "-s",
+        metavar="path",
+        type=str,
+        help="compile through sccache with this cache dir, shared by the "\
+            "unsafe and converted crates (most useful without --vendor)")
+    parser.add_argument("--bench-cache", "-b",
+        metavar="path",
+        type=str,
+        help="keep the builds of the unsafe baselines in this dir and restore "\
+            "them instead of compiling in later campaigns")
+    parser.add_argument("--incremental", "-i",
+        action="store_true",
+        help="only clean and rebuild the crates whose sources or toolchain "\
+            "changed since their last build")
+    parser.add_argument("--run-jobs",
+        metavar="N",
+        type=int,
+        help="number of benchmarks to run at the same time, each pinned to its "\
+            "own CPUs (NUMA node if possible) (if not specified, default is 1)")
+    parser.add_argument("--adaptive",
+        metavar="W",
+        type=float,
+        help="stop benchmarking a crate once the 95%% confidence interval of the "\
+            "safe/unsafe ratio of each of its benchmarks is narrower than W "\
+            "(e.g. 0.02); --num-runs is then the maximum number of runs")
+    parser.add_argument("--min-runs",
+        metavar="N",
+        type=int,
+        help="with --adaptive, the number of runs before a crate may stop "\
+            "(if not specified, default is 5)")
+    parser.add_argument("--interleave",
+        action="store_true",
+        help="run the benchmarks of a crate one at a time, alternating between "\
+            "the original and converted crate, instead of whole suites")
+    parser.add_argument("--rerun-cv",
+        metavar="CV",
+        type=float,
+        help="with --interleave, rerun the benchmarks whose safe/unsafe ratio "\
+            "has a coefficient of variation across runs above CV (if not "\
+            "specified, default is 0.05)")
+    parser.add_argument("--calibrate",
+        action="store_true",
+        help="instead of a campaign, benchmark the (compiled) crates serially "\
+            "and --run-jobs at a time, and compare the medians")
+    parser.add_argument("--shared-vendor",
+        action="store_true",
+        help="vendor every dependency once, in vendor-store/, for all crates, "\
+            "and convert it once per set of sites (implies --vendor)")
+    parser.add_argument("--mirror",
+        metavar="path",
+        type=str,
+        help="local mirror of the crate tarballs, filled from crates.io as "\
+            "needed (if not specified, default is crate-mirror/)")
+    parser.add_argument("--stages",
+        metavar="stage",
+        type=str,
+        nargs="+",
+        choices=STAGES,
+        default=STAGES,
+        help="stages to run, in this order: {} (if not specified, all of "\
+            "them)".format(", ".join(STAGES)))
+    parser.add_argument("--resume",
+        action="store_true",
+        help="skip what the manifest of a previous campaign records as done, "\
+            "and redo only what is missing or failed")
     args = parser.parse_args()
-    return args.crates, args.rust_version, args.vendor, args.num_runs
+    return args.crates, args.rust_version, args.vendor, args.num_runs, args.jobs, \
+        args.mem_cap, args.shared_cache, args.bench_cache, args.incremental, \
+        args.stages, args.resume, args.mirror, args.shared_vendor, args.run_jobs, args.calibrate, \
+        args.adaptive, args.min_runs, args.interleave, args.rerun_cv
 
 if __name__ == "__main__":
-    crates, rust_version, vendor, num_runs = arg_parse()
-
-    cio = CIO(crates, rust_version, vendor, num_runs)
-
-    #cio.download_crates()
-    #cio.set_rust_version()
-    #if rust_version == None: 
-    #    cio.convert_to_safe(mod=True)
-    #else: 
-    #    cio.convert_to_safe()
-
-    # Compile benchmarks and log duration
-    start = datetime.datetime.now()
-    #cio.compile_benchmarks()
-    end = datetime.datetime.now()
-    duration = end - start
-    durfile = "duration-compile"
-    with open(durfile, "w") as fd: 
-        fd.write("start:\t\t{}\n".format(start))
-        fd.write("end:\t\t{}\n".format(end))
-        fd.write("duration:\t{}\n".format(duration))
-
-    # Run benchmarks and log duration
-    start = datetime.datetime.now()
-    cio.run_benchmarks()
-    end = datetime.datetime.now()
-    duration = end - start
-    durfile = "duration-benchmark"
-    with open(durfile, "w") as fd: 
-        fd.write("start:\t\t{}\n".format(start))
-        fd.write("end:\t\t{}\n".format(end))
-        fd.write("duration:\t{}\n".format(duration))
-
-    # Aggregate results
-    cio.aggregate_results()
+    crates, rust_version, vendor, num_runs, jobs, mem_cap, shared_cache, bench_cache, \
+        incremental, stages, resume, mirror, shared_vendor, run_jobs, calibrate, \
+        adaptive, min_runs, interleave, rerun_cv = arg_parse()
+
+    cio = CIO(crates, rust_version, vendor, num_runs, jobs, mem_cap, shared_cache, bench_cache, 
+        incremental, resume, mirror, shared_vendor, run_jobs, min_runs, adaptive, interleave, 
+        rerun_cv)
+
+    if calibrate: 
+        sys.exit(0 if cio.calibrate() else 1)
+
+    # The modified rustc (no --rust-version) writes the mir-filelist
+    cio.run_stages(stages, mod=rust_version == None)
 
     # Generate plot
     #gen_figure1(cio.agg_results)